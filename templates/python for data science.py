@@ -63,6 +63,87 @@ df = pd.read_csv('file.csv', sep=',', skiprows=0)
 df = pd.read_excel('file.xlsx')
 #If data is too big, take a sample of it
 df = pd.read_csv('file.csv', nrows=50000)
+#nrows takes the head of the file, which is a biased sample if the file is sorted (e.g. logs ordered by time). Instead, read the file once
+#in chunks giving every row a random key and keep the rows with the smallest keys: a uniform random sample using a fixed amount of memory
+import pyarrow.parquet as pq
+
+def iter_chunks(filename, chunksize=1_000_000, columns=None, **kwargs):
+	if filename.endswith('.parquet'):
+		start = 0
+		for batch in pq.ParquetFile(filename).iter_batches(batch_size=chunksize, columns=columns):
+			chunk = batch.to_pandas()
+			chunk.index = pd.RangeIndex(start, start + len(chunk))
+			start += len(chunk)
+			yield chunk
+	else:
+		yield from pd.read_csv(filename, chunksize=chunksize, usecols=columns, **kwargs)
+
+def reservoir_sample(filename, n=50000, chunksize=1_000_000, random_state=101, **kwargs):
+	rng = np.random.default_rng(random_state)
+	sample = None
+	for chunk in iter_chunks(filename, chunksize, **kwargs):
+		chunk['_key'] = rng.random(len(chunk))
+		if sample is not None and len(sample) == n:
+			chunk = chunk[chunk['_key'] < sample['_key'].max()] #These rows would be discarded anyway
+		sample = chunk if sample is None else pd.concat([sample, chunk])
+		sample = sample.nsmallest(n, '_key')
+	return sample.sort_index().drop(columns='_key')
+
+#Stratified sample: keep up to n_per_stratum random rows of every value of column, so rare values are also in the sample.
+#sample_weight = rows in the file / rows in the sample for each value, use it to get unbiased statistics or as weights for a model
+def stratified_sample(filename, column, n_per_stratum=1000, chunksize=1_000_000, random_state=101, **kwargs):
+	rng = np.random.default_rng(random_state)
+	sample = None
+	counts = pd.Series(dtype=np.int64)
+	for chunk in iter_chunks(filename, chunksize, **kwargs):
+		chunk['_key'] = rng.random(len(chunk))
+		counts = counts.add(chunk[column].value_counts(dropna=False), fill_value=0)
+		sample = chunk if sample is None else pd.concat([sample, chunk])
+		sample = sample.sort_values('_key').groupby(column, dropna=False, sort=False).head(n_per_stratum)
+	sample = sample.sort_index().drop(columns='_key')
+	sample['sample_weight'] = sample[column].map(counts / sample[column].value_counts(dropna=False))
+	return sample
+
+df = reservoir_sample('file.csv', n=50000)
+df = stratified_sample('file.parquet', 'categorical_var', n_per_stratum=5000)
+#If data doesn't fit in memory, read it in chunks and downcast every chunk as it arrives with reduce_mem_usage (below). Peak memory depends on chunksize,
+#not on the file size. Integers stay signed unless unsigned=True
+def reconcile_dtypes(chunks):
+	""" find a common dtype for every column so the chunks can be concatenated
+		without pandas falling back to object or float64.
+	"""
+	dtypes = {}
+	for col in chunks[0].columns:
+		col_dtypes = [c[col].dtype for c in chunks]
+		if any(isinstance(d, pd.CategoricalDtype) for d in col_dtypes):
+			categories = [c[col].cat.categories if isinstance(c[col].dtype, pd.CategoricalDtype) else c[col].dropna().unique() for c in chunks]
+			dtypes[col] = pd.CategoricalDtype(pd.Index(np.concatenate([np.asarray(c, dtype=object) for c in categories])).unique())
+		elif all(d == col_dtypes[0] for d in col_dtypes):
+			dtypes[col] = col_dtypes[0]
+		elif all(isinstance(d, np.dtype) for d in col_dtypes):
+			dtypes[col] = np.result_type(*col_dtypes)
+		elif all(pd.api.types.is_numeric_dtype(d) and not pd.api.types.is_bool_dtype(d) for d in col_dtypes): #Nullable integers mixed with numpy dtypes
+			common = np.result_type(*[getattr(d, 'numpy_dtype', d) for d in col_dtypes])
+			dtypes[col] = pd.api.types.pandas_dtype(('UInt' if common.kind == 'u' else 'Int') + str(8 * common.itemsize)) if common.kind in 'iu' else common
+		else:
+			dtypes[col] = object
+	return dtypes
+
+def read_csv_chunked(filename, chunksize=1_000_000, unsigned=False, **kwargs):
+	for chunk in pd.read_csv(filename, chunksize=chunksize, **kwargs):
+		yield reduce_mem_usage(chunk, unsigned=unsigned, verbose=False)[0]
+
+def read_csv_compact(filename, chunksize=1_000_000, unsigned=False, **kwargs):
+	chunks = list(read_csv_chunked(filename, chunksize, unsigned, **kwargs))
+	dtypes = reconcile_dtypes(chunks)
+	for i in range(len(chunks)):
+		chunks[i] = chunks[i].astype(dtypes)
+	return pd.concat(chunks, ignore_index=True)
+
+df = read_csv_compact('file.csv', chunksize=500_000, sep=',')
+#Or process the file chunk by chunk without ever loading all of it
+for chunk in read_csv_chunked('file.csv', chunksize=500_000):
+	chunk.memory_usage().sum() / 1024**2 #MB
 #Load mat file
 from scipy.io import loadmat
 data = loadmat('file.mat')
@@ -75,65 +156,240 @@ for folder in main_folders:
 	lfolder = listdir(folder)
 	for f in lfolder:
 		path.join(folder, f)
+#Load all the files from folders or glob patterns in parallel. transform (e.g. select columns, reduce_mem_usage) runs inside the workers,
+#so only the reduced dataframes are sent back. transform must be picklable: a function defined with def, not a lambda
+import os
+import time
+from glob import glob
+from concurrent.futures import ProcessPoolExecutor, as_completed
+
+def list_files(sources, extensions=('.csv', '.parquet', '.feather')):
+	files = []
+	for source in sources:
+		if path.isdir(source):
+			files += sorted(path.join(source, f) for f in listdir(source) if f.endswith(extensions))
+		else:
+			files += sorted(glob(source, recursive=True))
+	return files
+
+def load_file(filename, transform=None, **kwargs):
+	start = time.perf_counter()
+	if filename.endswith('.parquet'):
+		df = pd.read_parquet(filename, **kwargs)
+	elif filename.endswith('.feather'):
+		df = pd.read_feather(filename, **kwargs)
+	else:
+		df = pd.read_csv(filename, **kwargs)
+	if transform is not None:
+		df = transform(df)
+	return df, time.perf_counter() - start
+
+def concat_frames(frames):
+	""" concatenate dataframes with the same columns allocating every output column only once.
+	"""
+	dtypes = reconcile_dtypes(frames)
+	offsets = np.cumsum([0] + [len(f) for f in frames])
+	columns = {}
+	for col, dtype in dtypes.items():
+		if isinstance(dtype, pd.CategoricalDtype):
+			codes = np.empty(offsets[-1], dtype=np.int32)
+			for f, start, stop in zip(frames, offsets[:-1], offsets[1:]):
+				values = f[col].cat if isinstance(f[col].dtype, pd.CategoricalDtype) else pd.Categorical(f[col].to_numpy(dtype=object)) #float16 can't be an index
+				category_codes = np.r_[dtype.categories.get_indexer(values.categories), -1] #The last one is for NaN (code -1), also when there are no categories
+				codes[start:stop] = category_codes[values.codes]
+			columns[col] = pd.Categorical.from_codes(codes, dtype=dtype)
+		elif isinstance(dtype, np.dtype) and dtype != object:
+			columns[col] = np.empty(offsets[-1], dtype=dtype)
+			for f, start, stop in zip(frames, offsets[:-1], offsets[1:]):
+				columns[col][start:stop] = f[col].to_numpy(dtype)
+		else:
+			columns[col] = pd.concat([f[col] for f in frames], ignore_index=True)
+	return pd.DataFrame(columns)
+
+def load_files(sources, transform=None, n_jobs=os.cpu_count(), **kwargs):
+	files = list_files(sources)
+	frames = [None] * len(files)
+	seconds = np.zeros(len(files))
+	with ProcessPoolExecutor(max_workers=n_jobs) as executor:
+		futures = {executor.submit(load_file, f, transform, **kwargs): i for i, f in enumerate(files)}
+		for future in tqdm(as_completed(futures), total=len(futures)):
+			i = futures[future]
+			frames[i], seconds[i] = future.result()
+	timings = pd.DataFrame({'file': files, 'rows': [len(f) for f in frames], 'seconds': seconds})
+	return concat_frames(frames), timings.sort_values('seconds', ascending=False)
+
+def select_and_reduce(df):
+	return reduce_mem_usage(df[['col1', 'col2']], verbose=False)[0]
+
+df, timings = load_files(['f1', 'f2', 'data/**/*.parquet'], transform=select_and_reduce, n_jobs=32)
 
 #Get memory usage
 df.memory_usage().sum() / 1024**2 #MB
 
 #Reduce dataframe memory usage
-def reduce_mem_usage(df):
-	""" iterate through all the columns of a dataframe and modify the data type
-		to reduce memory usage.
+#Stats are computed for all the columns of the same dtype at once, in row chunks. Floats are only downcast when every value
+#survives the round trip (or the error stays below float_tol), so there's no need to check the result afterwards. Integers stay
+#signed (unsigned ones wrap around in later arithmetic: uint8 5 - 20 = 241) unless unsigned=True or they were already unsigned
+def smallest_int_dtype(c_min, c_max, nullable=False, unsigned=False):
+	for dtype in ([np.uint8, np.uint16, np.uint32, np.uint64] if unsigned and c_min >= 0 else [np.int8, np.int16, np.int32, np.int64]):
+		if c_min >= np.iinfo(dtype).min and c_max <= np.iinfo(dtype).max:
+			dtype = np.dtype(dtype)
+			return pd.api.types.pandas_dtype(('UInt' if dtype.kind == 'u' else 'Int') + str(8 * dtype.itemsize)) if nullable else dtype
+
+def reduce_mem_usage(df, float_tol=0, max_cat_ratio=0.5, nullable_int=True, unsigned=False, chunksize=1_000_000, verbose=True):
+	""" downcast every column of a dataframe to the smallest dtype that keeps its values.
+		Returns the new dataframe and a report with the bytes saved and the max error of each column.
 	"""
-	start_mem = df.memory_usage().sum() / 1024**2
-	print('Memory usage of dataframe is {:.2f} MB'.format(start_mem))
-	
-	for col in df.columns:
-		col_type = df[col].dtype
-		
-		if col_type != object:
-			c_min = df[col].min()
-			c_max = df[col].max()
-			if str(col_type)[:3] == 'int':
-				if c_min > np.iinfo(np.int8).min and c_max < np.iinfo(np.int8).max:
-					df[col] = df[col].astype(np.int8)
-				elif c_min > np.iinfo(np.int16).min and c_max < np.iinfo(np.int16).max:
-					df[col] = df[col].astype(np.int16)
-				elif c_min > np.iinfo(np.int32).min and c_max < np.iinfo(np.int32).max:
-					df[col] = df[col].astype(np.int32)
-				elif c_min > np.iinfo(np.int64).min and c_max < np.iinfo(np.int64).max:
-					df[col] = df[col].astype(np.int64)  
-			else:
-				if c_min > np.finfo(np.float16).min and c_max < np.finfo(np.float16).max:
-					df[col] = df[col].astype(np.float16)
-				elif c_min > np.finfo(np.float32).min and c_max < np.finfo(np.float32).max:
-					df[col] = df[col].astype(np.float32)
-				else:
-					df[col] = df[col].astype(np.float64)
-		else:
-			df[col] = df[col].astype('category')
-
-	end_mem = df.memory_usage().sum() / 1024**2
-	print('Memory usage after optimization is: {:.2f} MB'.format(end_mem))
-	print('Decreased by {:.1f}%'.format(100 * (start_mem - end_mem) / start_mem))
-	
-	return df
-#Sometimes it changes some values in the dataframe, let's check it doesn't change anything
-df_test = pd.DataFrame()
-df_opt = reduce_mem_usage(df)
-for col in df:
-	df_test[col] = df[col] - df_opt[col]
-#Mean, max and min for all columns should be 0
-df_test.describe().loc['mean']
-df_test.describe().loc['max']
-df_test.describe().loc['min']
+	start_mem = df.memory_usage(deep=True, index=False)
+	old_dtypes = df.dtypes
+	new_dtypes = {}
+	max_error = pd.Series(0.0, index=df.columns)
+	if verbose:
+		print('Memory usage of dataframe is {:.2f} MB'.format(start_mem.sum() / 1024**2))
+
+	for dtype in old_dtypes.unique():
+		cols = df.columns[old_dtypes == dtype]
+		if len(df) == 0 or pd.api.types.is_bool_dtype(dtype):
+			continue
+		if isinstance(dtype, np.dtype) and dtype.kind in 'iuf':
+			candidates = [np.dtype(t) for t in (np.float16, np.float32) if dtype.kind == 'f' and np.dtype(t).itemsize < dtype.itemsize]
+			c_min = np.full(len(cols), np.inf)
+			c_max = np.full(len(cols), -np.inf)
+			integral = np.full(len(cols), dtype.kind == 'f')
+			has_nan = np.zeros(len(cols), dtype=bool)
+			errors = np.zeros((len(candidates), len(cols)))
+			for start in range(0, len(df), chunksize):
+				vals = df[cols].iloc[start:start + chunksize].to_numpy()
+				if dtype.kind in 'iu':
+					c_min = np.minimum(c_min, vals.min(axis=0))
+					c_max = np.maximum(c_max, vals.max(axis=0))
+					continue
+				nan = np.isnan(vals)
+				has_nan |= nan.any(axis=0)
+				with np.errstate(invalid='ignore', over='ignore'):
+					c_min = np.minimum(c_min, np.where(nan, np.inf, vals).min(axis=0))
+					c_max = np.maximum(c_max, np.where(nan, -np.inf, vals).max(axis=0))
+					integral &= (nan | (vals == np.round(vals))).all(axis=0)
+					for i, candidate in enumerate(candidates):
+						round_trip = vals.astype(candidate).astype(dtype)
+						same = (round_trip == vals) | (nan & np.isnan(round_trip))
+						errors[i] = np.maximum(errors[i], np.where(same, 0, np.abs(round_trip - vals)).max(axis=0))
+			for j, col in enumerate(cols):
+				if dtype.kind in 'iu':
+					new_dtypes[col] = smallest_int_dtype(c_min[j], c_max[j], unsigned=unsigned or dtype.kind == 'u')
+					continue
+				if nullable_int and integral[j] and np.isfinite(c_min[j]) and np.isfinite(c_max[j]):
+					new_dtypes[col] = smallest_int_dtype(c_min[j], c_max[j], nullable=has_nan[j], unsigned=unsigned)
+					if new_dtypes[col] is not None:
+						continue
+				for i, candidate in enumerate(candidates):
+					if errors[i, j] <= float_tol:
+						new_dtypes[col] = candidate
+						max_error[col] = errors[i, j]
+						break
+		elif pd.api.types.is_integer_dtype(dtype): #Nullable integers (Int64, UInt32...)
+			c_min, c_max = df[cols].min(), df[cols].max()
+			for col in cols:
+				if pd.notna(c_min[col]):
+					new_dtypes[col] = smallest_int_dtype(c_min[col], c_max[col], nullable=True, unsigned=unsigned or dtype.name.startswith('U'))
+		elif pd.api.types.is_object_dtype(dtype) or pd.api.types.is_string_dtype(dtype):
+			nunique = df[cols].nunique()
+			for col in cols:
+				if nunique[col] < max_cat_ratio * len(df):
+					new_dtypes[col] = 'category'
+
+	df = df.astype({col: t for col, t in new_dtypes.items() if t is not None and t != old_dtypes[col]})
+	end_mem = df.memory_usage(deep=True, index=False)
+	report = pd.DataFrame({'from': old_dtypes.astype(str), 'to': df.dtypes.astype(str),
+						   'bytes_before': start_mem, 'bytes_after': end_mem,
+						   'bytes_saved': start_mem - end_mem, 'max_abs_error': max_error})
+	if verbose:
+		print('Memory usage after optimization is: {:.2f} MB'.format(end_mem.sum() / 1024**2))
+		print('Decreased by {:.1f}%'.format(100 * (start_mem.sum() - end_mem.sum()) / start_mem.sum()))
+	return df, report
+df, mem_report = reduce_mem_usage(df)
+#Allow small errors in floats so more columns fit in float16/float32. max_abs_error in the report says how much each column changed
+df, mem_report = reduce_mem_usage(df, float_tol=1e-3)
+mem_report.sort_values('bytes_saved', ascending=False)
 
 #Save dataframe as csv
 df.to_csv('data.csv', index=False)
 
-#Save dataframe as h5
-df.to_hdf('df.h5', key='df', mode='w')
-#Read dataframe from h5
-df = pd.read_hdf('df.h5', 'df')
+#Save dataframe as parquet or feather. Columnar formats can read only some columns and feather files can be memory-mapped
+df.to_parquet('df.parquet', index=False, row_group_size=1_000_000)
+df = pd.read_parquet('df.parquet', columns=['col1', 'col2'], filters=[('col1', '>', 0)])
+df.to_feather('df.feather', compression='uncompressed')
+df = pd.read_feather('df.feather', columns=['col1', 'col2'])
+
+#Cache intermediate dataframes on disk. Entries are keyed by the source file path and content hash (only recomputed when mtime changes) and the loader with its arguments,
+#so rerunning the notebook reads the cached columns instead of parsing the source file again
+import hashlib
+import json
+import os
+import pyarrow as pa
+import pyarrow.feather as feather
+import pyarrow.parquet as pq
+
+def file_hash(filename, cache_dir='.cache', block_size=2**24):
+	index_file = path.join(cache_dir, 'hashes.json')
+	index = json.load(open(index_file)) if path.exists(index_file) else {}
+	stat = os.stat(filename)
+	key = path.abspath(filename)
+	if key in index and index[key]['mtime'] == stat.st_mtime_ns and index[key]['size'] == stat.st_size:
+		return index[key]['hash']
+	h = hashlib.blake2b(digest_size=16)
+	with open(filename, 'rb') as f:
+		for block in iter(lambda: f.read(block_size), b''):
+			h.update(block)
+	index[key] = {'mtime': stat.st_mtime_ns, 'size': stat.st_size, 'hash': h.hexdigest()}
+	os.makedirs(cache_dir, exist_ok=True)
+	with open(index_file, 'w') as f:
+		json.dump(index, f)
+	return index[key]['hash']
+
+def cache_path(source, name='raw', cache_dir='.cache', fmt='parquet', loader=None, kwargs=None):
+	#The loader and its arguments are part of the key, so cached_read('f.csv', usecols=['a']) and cached_read('f.csv') are different entries.
+	#All lambdas are called <lambda>: give a different name to every lambda loader
+	loader_name = '' if loader is None else getattr(loader, '__module__', '') + '.' + getattr(loader, '__qualname__', repr(loader))
+	key = hashlib.blake2b((path.abspath(source) + file_hash(source, cache_dir) + name + loader_name + repr(sorted((kwargs or {}).items()))).encode(), digest_size=16).hexdigest()
+	return path.join(cache_dir, '{}_{}.{}'.format(name, key, fmt))
+
+def write_cache(df, cache_file, row_group_size=1_000_000):
+	table = pa.Table.from_pandas(df, preserve_index=False)
+	tmp_file = cache_file + '.tmp'
+	if cache_file.endswith('.parquet'):
+		pq.write_table(table, tmp_file, row_group_size=row_group_size)
+	else:
+		feather.write_feather(table, tmp_file, compression='uncompressed') #Uncompressed so it can be memory-mapped
+	os.replace(tmp_file, cache_file) #An interrupted write never leaves a broken cache entry
+
+def read_cache(cache_file, columns=None, filters=None):
+	""" filters use the same format as pd.read_parquet, e.g. [('col1', '>', 0)]. With parquet the row groups
+		that can't match are skipped using their min/max statistics.
+	"""
+	if cache_file.endswith('.parquet'):
+		table = pq.read_table(cache_file, columns=columns, filters=filters, memory_map=True)
+	else:
+		#Memory-mapped: nothing is copied until the filter or to_pandas. The filtered columns are read too and dropped after filtering
+		filter_columns = [f[0] for group in (filters or []) for f in (group if isinstance(group, list) else [group])] #[(...)] or [[(...)], [(...)]]
+		read_columns = None if columns is None else list(dict.fromkeys(list(columns) + filter_columns))
+		table = feather.read_table(cache_file, columns=read_columns, memory_map=True)
+		if filters:
+			table = table.filter(pq.filters_to_expression(filters))
+		if columns is not None:
+			table = table.select(list(columns))
+	return table.to_pandas()
+
+def cached_read(source, loader=pd.read_csv, name='raw', cache_dir='.cache', fmt='parquet', columns=None, filters=None, **kwargs):
+	cache_file = cache_path(source, name, cache_dir, fmt, loader, kwargs)
+	if not path.exists(cache_file):
+		write_cache(loader(source, **kwargs), cache_file)
+	return read_cache(cache_file, columns, filters)
+
+df = cached_read('file.csv', sep=',')
+df = cached_read('file.csv', columns=['col1', 'col2'], filters=[('col1', '>', 0)])
+#Cache the output of a slow feature engineering step with its own name, it's invalidated when the source file changes
+df = cached_read('file.csv', loader=lambda f: build_features(read_csv_compact(f)), name='features', fmt='feather')
 
 #Improve execution speed of your code by adding these decorators:
 @numba.jit
@@ -192,6 +448,201 @@ prof.to_file(output_file='output.html')
 #For a big dataset that takes too long to create the report, use minimal. It will generate a simplified report.
 profile = ProfileReport(df, minimal=True)
 profile.to_file(output_file="output_min.html")
+#For a dataset that doesn't fit in memory, profile it with mergeable sketches: HyperLogLog for distinct values, KLL for quantiles and
+#histograms and count-min for the most frequent values. Partitions (files) are profiled in parallel and the results are merged.
+#Memory depends on error, not on the number of rows: distinct counts within ~error relative error, quantiles within ~error in rank,
+#frequencies overestimated by at most error * rows (values less frequent than that are not listed)
+from itertools import repeat
+
+class HyperLogLog:
+	def __init__(self, error=0.01):
+		self.p = int(np.clip(np.ceil(np.log2((1.04 / error)**2)), 4, 18))
+		self.registers = np.zeros(2**self.p, dtype=np.uint8)
+
+	def update(self, hashes):
+		index = (hashes >> np.uint64(64 - self.p)).astype(np.int64)
+		rest = (hashes << np.uint64(self.p)) | np.uint64(1 << (self.p - 1))
+		rank = np.maximum(65 - np.frexp(rest.astype(np.float64))[1], 1) #Position of the first 1 bit
+		np.maximum.at(self.registers, index, rank.astype(np.uint8))
+
+	def merge(self, other):
+		self.registers = np.maximum(self.registers, other.registers)
+
+	def count(self):
+		m = len(self.registers)
+		estimate = 0.7213 / (1 + 1.079 / m) * m**2 / np.sum(2.0 ** -self.registers.astype(np.float64))
+		zeros = np.count_nonzero(self.registers == 0)
+		if estimate <= 2.5 * m and zeros > 0:
+			estimate = m * np.log(m / zeros) #Linear counting is more accurate for small cardinalities
+		return int(round(estimate))
+
+class KLL:
+	def __init__(self, error=0.01, random_state=101):
+		self.k = int(np.ceil(2 / error))
+		self.rng = np.random.default_rng(random_state)
+		self.levels = [np.empty(0)] #An item in level h stands for 2**h values
+
+	def capacity(self, level):
+		return max(2, int(np.ceil(self.k * (2 / 3)**(len(self.levels) - level - 1))))
+
+	def update(self, values):
+		self.levels[0] = np.concatenate([self.levels[0], values])
+		self.compress()
+
+	def merge(self, other):
+		self.levels += [np.empty(0)] * (len(other.levels) - len(self.levels))
+		for level, items in enumerate(other.levels):
+			self.levels[level] = np.concatenate([self.levels[level], items])
+		self.compress()
+
+	def compress(self):
+		level = 0
+		while level < len(self.levels):
+			if len(self.levels[level]) >= self.capacity(level):
+				if level + 1 == len(self.levels):
+					self.levels.append(np.empty(0))
+				items = np.sort(self.levels[level])
+				even = len(items) - len(items) % 2
+				self.levels[level + 1] = np.concatenate([self.levels[level + 1], items[self.rng.integers(2):even:2]]) #Keep every other item
+				self.levels[level] = items[even:]
+			level += 1
+
+	def sorted_items(self):
+		items = np.concatenate(self.levels)
+		weights = np.concatenate([np.full(len(items), 2.0**level) for level, items in enumerate(self.levels)])
+		order = np.argsort(items)
+		return items[order], np.cumsum(weights[order])
+
+	def quantiles(self, q):
+		items, cumulative = self.sorted_items()
+		return items[np.minimum(np.searchsorted(cumulative, np.asarray(q) * cumulative[-1]), len(items) - 1)]
+
+	def histogram(self, edges):
+		items, cumulative = self.sorted_items()
+		below = np.r_[0, cumulative][np.searchsorted(items, edges, side='right')]
+		below[0] = 0 #The first bin also includes the values equal to its left edge
+		return np.diff(below)
+
+class CountMinTopK:
+	def __init__(self, error=0.01, delta=0.01, top=10, random_state=101):
+		rng = np.random.default_rng(random_state)
+		depth = int(np.ceil(np.log(1 / delta)))
+		self.bits = int(np.ceil(np.log2(np.e / error)))
+		self.a = rng.integers(0, 2**64, depth, dtype=np.uint64, endpoint=False) | np.uint64(1)
+		self.b = rng.integers(0, 2**64, depth, dtype=np.uint64, endpoint=False)
+		self.table = np.zeros((depth, 2**self.bits), dtype=np.int64)
+		self.error = error
+		self.top = top
+		self.candidates = {} #hash -> value of the current most frequent values
+
+	def index(self, hashes):
+		return ((self.a[:, None] * hashes[None, :] + self.b[:, None]) >> np.uint64(64 - self.bits)).astype(np.int64)
+
+	def estimate(self, hashes):
+		return self.table[np.arange(len(self.table))[:, None], self.index(hashes)].min(axis=0)
+
+	def update(self, hashes, counts, values):
+		np.add.at(self.table, (np.arange(len(self.table))[:, None], self.index(hashes)), counts[None, :])
+		for i in np.argsort(-counts)[:2 * self.top]:
+			self.candidates[int(hashes[i])] = values[i]
+		self.prune()
+
+	def merge(self, other):
+		self.table += other.table
+		self.candidates.update(other.candidates)
+		self.prune()
+
+	def prune(self):
+		hashes = np.fromiter(self.candidates, dtype=np.uint64, count=len(self.candidates))
+		keep = hashes[np.argsort(-self.estimate(hashes), kind='stable')[:2 * self.top]]
+		self.candidates = {int(h): self.candidates[int(h)] for h in keep}
+
+	def most_frequent(self):
+		hashes = np.fromiter(self.candidates, dtype=np.uint64, count=len(self.candidates))
+		counts = self.estimate(hashes)
+		min_count = self.error * self.table[0].sum() #Below this the count could be only the error of the sketch
+		return [(self.candidates[int(hashes[i])], int(counts[i])) for i in np.argsort(-counts, kind='stable')[:self.top] if counts[i] > min_count]
+
+class ColumnProfile:
+	def __init__(self, numeric, error=0.01, top=10):
+		self.rows = 0
+		self.nulls = 0
+		self.min = np.inf
+		self.max = -np.inf
+		self.distinct = HyperLogLog(error)
+		self.frequent = CountMinTopK(error, top=top)
+		self.quantiles = KLL(error) if numeric else None
+
+	def update(self, s):
+		self.rows += len(s)
+		self.nulls += int(s.isna().sum())
+		counts = s.value_counts()
+		hashes = pd.util.hash_array(counts.index.to_numpy())
+		self.distinct.update(hashes)
+		self.frequent.update(hashes, counts.to_numpy(), counts.index.to_numpy())
+		if self.quantiles is not None:
+			values = s.to_numpy(np.float64, na_value=np.nan)
+			values = values[np.isfinite(values)]
+			if len(values):
+				self.min, self.max = min(self.min, values.min()), max(self.max, values.max())
+				self.quantiles.update(values)
+
+	def merge(self, other):
+		self.rows += other.rows
+		self.nulls += other.nulls
+		self.min, self.max = min(self.min, other.min), max(self.max, other.max)
+		self.distinct.merge(other.distinct)
+		self.frequent.merge(other.frequent)
+		if self.quantiles is not None:
+			self.quantiles.merge(other.quantiles)
+
+def profile_chunks(chunks, error=0.01, top=10):
+	profile = None
+	for chunk in ([chunks] if isinstance(chunks, pd.DataFrame) else chunks):
+		if profile is None:
+			profile = {col: ColumnProfile(pd.api.types.is_numeric_dtype(chunk[col]) and not pd.api.types.is_bool_dtype(chunk[col]), error, top) for col in chunk.columns}
+		for col, column_profile in profile.items():
+			column_profile.update(chunk[col])
+	return profile
+
+def profile_file(filename, error=0.01, top=10, chunksize=1_000_000):
+	return profile_chunks(iter_chunks(filename, chunksize), error, top)
+
+def profile_files(files, error=0.01, top=10, chunksize=1_000_000, n_jobs=os.cpu_count()):
+	with ProcessPoolExecutor(max_workers=n_jobs) as executor:
+		profiles = list(tqdm(executor.map(profile_file, files, repeat(error), repeat(top), repeat(chunksize)), total=len(files)))
+	profile = profiles[0]
+	for other in profiles[1:]:
+		for col in profile:
+			profile[col].merge(other[col])
+	return profile
+
+def profile_summary(profile, bins=20, q=(0.01, 0.05, 0.25, 0.5, 0.75, 0.95, 0.99)):
+	summary = {}
+	for col, p in profile.items():
+		summary[col] = {'rows': p.rows, 'nulls': p.nulls, 'null_pct': 100 * p.nulls / max(p.rows, 1), 'distinct': p.distinct.count(),
+						'most_frequent': [(str(value), count) for value, count in p.frequent.most_frequent()]}
+		if p.quantiles is not None and np.isfinite(p.min):
+			edges = np.linspace(p.min, p.max, bins + 1)
+			summary[col].update({'min': float(p.min), 'max': float(p.max),
+								 'quantiles': dict(zip(map(str, q), p.quantiles.quantiles(q).tolist())),
+								 'histogram': {'edges': edges.tolist(), 'counts': p.quantiles.histogram(edges).tolist()}})
+	return summary
+
+def profile_to_html(summary, filename):
+	bars = ' ▁▂▃▄▅▆▇█'
+	table = pd.DataFrame({col: {'rows': s['rows'], 'null %': round(s['null_pct'], 2), 'distinct (approx.)': s['distinct'],
+								'min': s.get('min'), **s.get('quantiles', {}), 'max': s.get('max'),
+								'histogram': ''.join(bars[int(np.ceil(8 * c / max(max(s['histogram']['counts']), 1)))] for c in s['histogram']['counts']) if 'histogram' in s else '',
+								'most frequent (approx. count)': ', '.join('{} ({})'.format(v, c) for v, c in s['most_frequent'])}
+						  for col, s in summary.items()}).T
+	table.to_html(filename)
+
+profile = profile_files(list_files(['data/']), error=0.01, n_jobs=32)
+profile = profile_chunks(iter_chunks('file.csv'), error=0.01) #One file, no parallelism
+summary = profile_summary(profile)
+json.dump(summary, open('profile.json', 'w'), indent=2)
+profile_to_html(summary, 'profile.html')
 #Interactive data visualization
 import dtale
 d = dtale.show(df)
@@ -274,6 +725,104 @@ df.replace(-np.inf,0,inplace=True)
 #Check for duplicated data
 df.duplicated().value_counts()
 df['duplicated'] = df.duplicated() #Create a new feature
+#Check missing, infinite and duplicated data, skewness, min/max and cardinality in a single pass. Works with a dataframe
+#or with the chunks of a file that doesn't fit in memory, e.g. scan_data(iter_chunks('file.csv'))
+#Distinct values are counted on hashes: only hashes below a threshold are kept and the threshold is halved whenever there are more than
+#max_size of them. Equal values have equal hashes, so they are kept or dropped together. Exact while less than max_size values are seen
+class HashSample:
+	def __init__(self, max_size=2**16, with_counts=False):
+		self.max_size = max_size
+		self.level = 0 #Only hashes < 2**(64 - level) are kept
+		self.hashes = np.empty(0, dtype=np.uint64)
+		self.counts = np.empty(0, dtype=np.int64) if with_counts else None
+
+	def keep(self, hashes):
+		return (hashes >> np.uint64(64 - self.level)) == 0
+
+	def update(self, hashes):
+		if self.level:
+			hashes = hashes[self.keep(hashes)]
+		hashes = np.concatenate([self.hashes, hashes])
+		if self.counts is None:
+			hashes.sort()
+		else:
+			order = np.argsort(hashes)
+			hashes = hashes[order]
+			counts = np.concatenate([self.counts, np.ones(len(order) - len(self.counts), dtype=np.int64)])[order]
+		first = np.flatnonzero(np.r_[True, hashes[1:] != hashes[:-1]]) if len(hashes) else np.empty(0, dtype=np.int64)
+		self.hashes = hashes[first]
+		if self.counts is not None:
+			self.counts = np.add.reduceat(counts, first) if len(first) else counts
+		while len(self.hashes) > self.max_size:
+			self.level += 1
+			mask = self.keep(self.hashes)
+			self.hashes = self.hashes[mask]
+			if self.counts is not None:
+				self.counts = self.counts[mask]
+
+	def distinct(self):
+		return len(self.hashes) * 2**self.level
+
+	def duplicated(self):
+		return int(self.counts.sum() - len(self.counts)) * 2**self.level
+
+def scan_data(data, max_hashes=2**16):
+	chunks = [data] if isinstance(data, pd.DataFrame) else data
+	rows = 0
+	for chunk in chunks:
+		if rows == 0:
+			columns = chunk.columns
+			numeric = chunk.select_dtypes(include='number').columns
+			nulls = np.zeros(len(columns), dtype=np.int64)
+			pos_inf, neg_inf, finite = (np.zeros(len(numeric), dtype=np.int64) for _ in range(3))
+			c_min, c_max = np.full(len(numeric), np.inf), np.full(len(numeric), -np.inf)
+			power_sums = np.zeros((3, len(numeric)))
+			shift = None
+			cardinality = {col: HashSample(max_hashes) for col in columns}
+			row_hashes = HashSample(max_hashes, with_counts=True)
+		rows += len(chunk)
+		nulls += chunk.isna().sum().to_numpy()
+		row_hashes.update(pd.util.hash_pandas_object(chunk, index=False).to_numpy())
+		vals = chunk[numeric].to_numpy(np.float64)
+		is_finite = np.isfinite(vals)
+		finite += is_finite.sum(axis=0)
+		d = vals.copy()
+		if not is_finite.all():
+			pos_inf += np.isposinf(vals).sum(axis=0)
+			neg_inf += np.isneginf(vals).sum(axis=0)
+			d[~is_finite] = np.nan
+		c_min = np.fmin(c_min, np.nanmin(d, axis=0, initial=np.inf))
+		c_max = np.fmax(c_max, np.nanmax(d, axis=0, initial=-np.inf))
+		if shift is None:
+			#Power sums around a value close to the mean to avoid cancellation errors
+			shift = np.nan_to_num(np.nanmean(d, axis=0))
+		d -= shift
+		d[~is_finite] = 0
+		d2 = d * d
+		power_sums += [d.sum(axis=0), d2.sum(axis=0), (d2 * d).sum(axis=0)]
+		hashes = pd.util.hash_array(vals.ravel(order='F')).reshape(vals.shape, order='F')
+		for j, col in enumerate(numeric):
+			cardinality[col].update(hashes[~np.isnan(vals[:, j]), j])
+		for col in columns.difference(numeric, sort=False):
+			s = chunk[col].dropna()
+			cardinality[col].update(pd.util.hash_pandas_object(s, index=False).to_numpy())
+
+	with np.errstate(invalid='ignore', divide='ignore'):
+		m1, m2, m3 = power_sums / finite
+		var = m2 - m1**2
+		skewness = (m3 - 3 * m1 * m2 + 2 * m1**3) / var**1.5 #Same as scipy.stats.skew
+	report = pd.DataFrame({'dtype': chunk.dtypes.astype(str), 'nulls': nulls, 'null_pct': 100 * nulls / rows,
+						   'distinct': [cardinality[col].distinct() for col in columns]}, index=columns)
+	report = report.join(pd.DataFrame({'pos_inf': pos_inf, 'neg_inf': neg_inf, 'min': np.where(finite > 0, c_min, np.nan),
+									   'max': np.where(finite > 0, c_max, np.nan), 'skew': skewness}, index=numeric))
+	report.attrs['rows'] = rows
+	report.attrs['duplicated_rows'] = row_hashes.duplicated()
+	return report
+
+report = scan_data(df)
+report = scan_data(iter_chunks('file.csv', chunksize=500_000))
+report.sort_values('null_pct', ascending=False)
+report.attrs['duplicated_rows']
 
 #Fill missing data 
 df.fillna()
@@ -282,14 +831,181 @@ from sklearn.impute import SimpleImputer
 si = SimpleImputer()
 imputed_X_train = pd.DataFrame(si.fit_transform(X_train))
 imputed_X_val = pd.DataFrame(si.transform(X_val))
-#Find nan values and fill them however you want
-for i in df.iterrows():
-	if np.isnan(i[1][col]):
-		df[col].loc[i[0]] = i*3
+#Find nan values and fill them however you want. Declare one rule per column and they're applied with vectorized (grouped) operations:
+#'median', 'mean', 'min', 'max' (optionally by group, learned with fit so the same values are used with the test set; groups not seen
+#in fit get the global value), 'constant', 'ffill'/'bfill' (optionally within group) or a function that returns the fill values
+from sklearn import base
+
+fill_rules = {'col1': 'median',
+			  'col2': {'strategy': 'median', 'by': ['group1', 'group2']},
+			  'col3': {'strategy': 'constant', 'value': 0},
+			  'col4': {'strategy': 'ffill', 'by': 'series_id'},
+			  'col5': lambda df: df['col6'] * 3}
+
+class NanFiller(base.BaseEstimator, base.TransformerMixin):
+	def __init__(self, rules):
+		self.rules = rules
+
+	def rule_groups(self):
+		""" columns with the same rule are filled together.
+		"""
+		groups = {}
+		for col, rule in self.rules.items():
+			if callable(rule):
+				continue
+			rule = {'strategy': rule} if isinstance(rule, str) else rule
+			by = rule.get('by') or []
+			key = (rule['strategy'], tuple([by] if isinstance(by, str) else by), rule.get('value'))
+			groups.setdefault(key, []).append(col)
+		return groups
+
+	def fit(self, X, y=None):
+		self.values_ = {}
+		for (strategy, by, value), cols in self.rule_groups().items():
+			if strategy in ('mean', 'median', 'min', 'max'):
+				group_values = X.groupby(list(by))[cols].agg(strategy) if by else None
+				self.values_[strategy, by, value] = (group_values, X[cols].agg(strategy))
+			elif strategy not in ('constant', 'ffill', 'bfill'):
+				raise ValueError('Unknown strategy: {}'.format(strategy))
+		return self
+
+	def transform(self, X):
+		X = X.copy()
+		for (strategy, by, value), cols in self.rule_groups().items():
+			if strategy == 'constant':
+				X[cols] = X[cols].fillna(value)
+			elif strategy in ('ffill', 'bfill'):
+				X[cols] = getattr(X.groupby(list(by))[cols] if by else X[cols], strategy)()
+			else:
+				group_values, global_values = self.values_[strategy, by, value]
+				if group_values is not None:
+					keys = pd.MultiIndex.from_frame(X[list(by)]) if len(by) > 1 else pd.Index(X[by[0]])
+					X[cols] = X[cols].fillna(group_values.reindex(keys).set_axis(X.index))
+				X[cols] = X[cols].fillna(global_values)
+		for col, rule in self.rules.items():
+			if callable(rule):
+				X[col] = X[col].fillna(rule(X))
+		return X
+
+filler = NanFiller(fill_rules)
+X_train = filler.fit_transform(X_train)
+X_val = filler.transform(X_val)
 #Fill NaNs generating predictions with KNN
 from sklearn.impute import KNNImputer
 imputer = KNNImputer(n_neighbors=5)
 imputer.fit_transform(X_train)
+#KNNImputer compares every row with all the others. For big tables, search the neighbours only among the rows in the same leaf of a few
+#random projection trees (each split is the median along a random direction). Cost per row depends on leaf_size and n_trees, not on the
+#number of rows. Distances ignore the missing coordinates like sklearn's nan_euclidean_distances. Chunks of rows are imputed in threads
+from concurrent.futures import ThreadPoolExecutor
+
+def nan_euclidean(A, B):
+	mask_a, mask_b = ~np.isnan(A), ~np.isnan(B)
+	A0, B0 = np.nan_to_num(A), np.nan_to_num(B)
+	squares = (A0**2) @ mask_b.T + mask_a @ (B0**2).T - 2 * A0 @ B0.T
+	present = mask_a.astype(np.float64) @ mask_b.T
+	with np.errstate(divide='ignore', invalid='ignore'):
+		return np.where(present > 0, np.sqrt(np.maximum(squares, 0) * A.shape[1] / present), np.inf)
+
+class ApproxKNNImputer(base.BaseEstimator, base.TransformerMixin):
+	def __init__(self, n_neighbors=5, n_trees=4, leaf_size=1024, chunksize=500_000, n_jobs=os.cpu_count(), random_state=101):
+		self.n_neighbors = n_neighbors
+		self.n_trees = n_trees
+		self.leaf_size = leaf_size
+		self.chunksize = chunksize
+		self.n_jobs = n_jobs
+		self.random_state = random_state
+
+	def fit(self, X, y=None):
+		self.fit_X_ = np.asarray(X, dtype=np.float64)
+		self.mean_ = np.nanmean(self.fit_X_, axis=0)
+		self.scale_ = np.nanstd(self.fit_X_, axis=0)
+		self.scale_[~(self.scale_ > 0)] = 1
+		self.donors_ = (self.fit_X_ - self.mean_) / self.scale_
+		rng = np.random.default_rng(self.random_state)
+		self.trees_ = [self.build_tree(np.nan_to_num(self.donors_), rng) for _ in range(self.n_trees)]
+		return self
+
+	def build_tree(self, Z, rng):
+		tree = {'direction': [], 'split': [], 'left': [], 'right': [], 'leaf': [], 'leaves': []}
+		def new_node():
+			for key, default in (('direction', np.zeros(Z.shape[1])), ('split', 0.0), ('left', -1), ('right', -1), ('leaf', -1)):
+				tree[key].append(default)
+			return len(tree['leaf']) - 1
+		stack = [(np.arange(len(Z)), new_node())]
+		while stack:
+			idx, node = stack.pop()
+			if len(idx) > self.leaf_size:
+				direction = rng.normal(size=Z.shape[1])
+				projection = Z[idx] @ direction
+				split = np.median(projection)
+				left = projection <= split
+				if 0 < left.sum() < len(idx): #Otherwise all the rows are equal along direction
+					tree['direction'][node], tree['split'][node] = direction, split
+					tree['left'][node], tree['right'][node] = new_node(), new_node()
+					stack += [(idx[left], tree['left'][node]), (idx[~left], tree['right'][node])]
+					continue
+			tree['leaf'][node] = len(tree['leaves'])
+			tree['leaves'].append(idx)
+		return {key: (value if key == 'leaves' else np.array(value)) for key, value in tree.items()}
+
+	def find_leaves(self, tree, Z):
+		node = np.zeros(len(Z), dtype=np.int64)
+		internal = np.flatnonzero(tree['leaf'][node] < 0)
+		while len(internal):
+			current = node[internal]
+			go_left = np.einsum('ij,ij->i', Z[internal], tree['direction'][current]) <= tree['split'][current]
+			node[internal] = np.where(go_left, tree['left'][current], tree['right'][current])
+			internal = internal[tree['leaf'][node[internal]] < 0]
+		return tree['leaf'][node]
+
+	def impute_chunk(self, X):
+		k = self.n_neighbors
+		Z = (X - self.mean_) / self.scale_
+		missing = np.isnan(X)
+		rows, cols = np.nonzero(missing)
+		cell = np.full(X.shape, -1)
+		cell[rows, cols] = np.arange(len(rows))
+		candidates = np.full((len(rows), self.n_trees * k), -1)
+		distances = np.full((len(rows), self.n_trees * k), np.inf)
+		for t, tree in enumerate(self.trees_):
+			leaf = self.find_leaves(tree, np.nan_to_num(Z))
+			order = np.argsort(leaf, kind='stable')
+			leaf_ids, starts = np.unique(leaf[order], return_index=True)
+			for leaf_id, queries in zip(leaf_ids, np.split(order, starts[1:])):
+				donors = tree['leaves'][leaf_id]
+				dist = nan_euclidean(Z[queries], self.donors_[donors])
+				for f in np.flatnonzero(missing[queries].any(axis=0)):
+					q = np.flatnonzero(missing[queries, f])
+					dist_f = np.where(np.isnan(self.donors_[donors, f]), np.inf, dist[q])
+					kk = min(k, len(donors))
+					nearest = np.argpartition(dist_f, kk - 1, axis=1)[:, :kk]
+					candidates[cell[queries[q], f], t * k:t * k + kk] = donors[nearest]
+					distances[cell[queries[q], f], t * k:t * k + kk] = np.take_along_axis(dist_f, nearest, axis=1)
+		#The same donor can be found by several trees, count it only once
+		order = np.argsort(candidates, axis=1)
+		candidates, distances = np.take_along_axis(candidates, order, axis=1), np.take_along_axis(distances, order, axis=1)
+		distances[:, 1:][candidates[:, 1:] == candidates[:, :-1]] = np.inf
+		nearest = np.argsort(distances, axis=1)[:, :k]
+		candidates, distances = np.take_along_axis(candidates, nearest, axis=1), np.take_along_axis(distances, nearest, axis=1)
+		values = np.where(np.isfinite(distances), self.fit_X_[candidates, cols[:, None]], np.nan)
+		found = np.isfinite(distances).any(axis=1)
+		X = X.copy()
+		X[rows, cols] = np.where(found, np.nanmean(np.where(found[:, None], values, 0), axis=1), self.mean_[cols]) #Column mean if there are no neighbours
+		return X
+
+	def transform(self, X):
+		values = np.array(X, dtype=np.float64)
+		incomplete = np.flatnonzero(np.isnan(values).any(axis=1))
+		chunks = [incomplete[start:start + self.chunksize] for start in range(0, len(incomplete), self.chunksize)]
+		with ThreadPoolExecutor(max_workers=self.n_jobs) as executor: #Most of the time is spent in numpy, which releases the GIL
+			for rows, imputed in zip(chunks, executor.map(lambda rows: self.impute_chunk(values[rows]), chunks)):
+				values[rows] = imputed
+		return pd.DataFrame(values, index=X.index, columns=X.columns) if isinstance(X, pd.DataFrame) else values
+
+imputer = ApproxKNNImputer(n_neighbors=5, n_trees=4, leaf_size=1024)
+X_train = imputer.fit_transform(X_train)
+X_val = imputer.transform(X_val)
 
 #Drop columns/rows
 df.drop('column_full_of_nans')
@@ -307,30 +1023,101 @@ skewed_features = skewness.index
 lambd = 0.15
 for feat in skewed_features:
 	df[feat] = boxcox1p(df[feat], lambd)
-#check different approaches to fix skewness:
-skewed_features = skewness.index
-for feature in skewed_features:
-	original_skewness = skewness.loc[feature]['Skew']
-	try:
-		log_transform = skew(df[feature].apply(log1p))
-		lambd = 0.15
-		boxcox_transform = skew(boxcox1p(df[feature], lambd))
-		print(f'{feature}')
-		print(f'Original skewness: {original_skewness}')
-		print(f'log1p transform skewness: {log_transform}')
-		print(f'boxcox1p transform: {boxcox_transform}')
-		print(f'Log1p Change: {original_skewness-log_transform}')
-		print(f'BoxCox1p Change: {original_skewness-boxcox_transform}')
-		if original_skewness > 0.5:
-			if log_transform < 0.5 and log_transform > -0.5:
-				print(f'Feature: {feature}, original skewness: {original_skewness}, new skewness: {log_transform}')
-			if original_skewness-log_transform > 0.5:
-				print(f'big change with feature {feature}, change: {original_skewness-log_transform}, new skewness: {log_transform}')
-		if original_skewness < -0.5:
-			if log_transform < 0.5 and log_transform > -0.5:
-				print(f'Feature: {feature}, original skewness: {original_skewness}, new skewness: {log_transform}')
-			if original_skewness-log_transform > 0.5:
-				print(f'big change with feature {feature}, change: {original_skewness-log_transform}, new skewness: {log_transform}')
+#check different approaches to fix skewness: log1p, sqrt, yeo-johnson and boxcox1p, the lambdas are searched on a grid for all
+#the values at once (then on finer grids around the best one). The transformation with the lowest skewness is kept for every column
+#with abs(skew) > threshold. The search runs on a sample of rows, with blocks of columns in parallel
+
+def boxcox1p_grid(x, lambdas):
+	""" boxcox1p of x for many lambdas at once, one column per lambda.
+	"""
+	log_x = np.log1p(x)[:, None]
+	with np.errstate(over='ignore', invalid='ignore'):
+		return np.where(lambdas == 0, log_x, np.expm1(log_x * lambdas) / np.where(lambdas == 0, 1, lambdas))
+
+def yeo_johnson_grid(x, lambdas):
+	positive = x >= 0
+	result = np.empty((len(x), len(lambdas)))
+	result[positive] = boxcox1p_grid(x[positive], lambdas)
+	result[~positive] = -boxcox1p_grid(-x[~positive], 2 - lambdas)
+	return result
+
+def skew_grid(y):
+	d = y - y.mean(axis=0)
+	d2 = d * d
+	with np.errstate(over='ignore', invalid='ignore'):
+		return (d2 * d).mean(axis=0) / d2.mean(axis=0)**1.5 #Same as scipy.stats.skew(y, axis=0)
+
+def skew_transforms(x, lambdas, refinements=2):
+	x = x[np.isfinite(x)]
+	result = {'original': np.nan, 'log1p': np.nan, 'sqrt': np.nan, 'yeo-johnson': np.nan, 'yeo-johnson_lambda': np.nan, 'boxcox1p': np.nan, 'boxcox1p_lambda': np.nan}
+	if len(x) < 3: #Empty or almost empty column, it's left as it is
+		return result
+	result['original'] = skew(x)
+	transforms = {'yeo-johnson': yeo_johnson_grid}
+	if x.min() > -1:
+		result['log1p'] = skew(np.log1p(x))
+		transforms['boxcox1p'] = boxcox1p_grid
+	if x.min() >= 0:
+		result['sqrt'] = skew(np.sqrt(x))
+	for name, f in transforms.items():
+		grid = lambdas
+		for _ in range(refinements + 1):
+			skewness = np.abs(skew_grid(f(x, grid)))
+			best = grid[np.argmin(np.where(np.isnan(skewness), np.inf, skewness))]
+			step = grid[1] - grid[0]
+			grid = np.linspace(best - step, best + step, 11)
+		result[name] = skew_grid(f(x, np.array([best])))[0]
+		result[name + '_lambda'] = best
+	return result
+
+def skew_transforms_block(X, lambdas):
+	return [skew_transforms(X[:, j], lambdas) for j in range(X.shape[1])]
+
+class SkewFixer(base.BaseEstimator, base.TransformerMixin):
+	def __init__(self, columns=None, threshold=0.5, lambdas=np.linspace(-3, 3, 13), sample_size=100_000, block_size=16, n_jobs=os.cpu_count(), random_state=101):
+		self.columns = columns
+		self.threshold = threshold
+		self.lambdas = lambdas
+		self.sample_size = sample_size
+		self.block_size = block_size
+		self.n_jobs = n_jobs
+		self.random_state = random_state
+
+	def fit(self, X, y=None):
+		columns = pd.Index(self.columns if self.columns is not None else X.select_dtypes(include='number').columns)
+		sample = X[columns].sample(min(self.sample_size, len(X)), random_state=self.random_state).to_numpy(np.float64)
+		blocks = [sample[:, start:start + self.block_size] for start in range(0, len(columns), self.block_size)]
+		if self.n_jobs == 1:
+			results = [skew_transforms_block(block, self.lambdas) for block in blocks]
+		else:
+			with ProcessPoolExecutor(max_workers=self.n_jobs) as executor:
+				results = list(executor.map(skew_transforms_block, blocks, repeat(self.lambdas)))
+		report = pd.DataFrame([r for block in results for r in block], index=columns)
+		skewness = report[['original', 'log1p', 'sqrt', 'yeo-johnson', 'boxcox1p']].abs().fillna(np.inf)
+		report['best'] = skewness.idxmin(axis=1)
+		report.loc[(report['original'].abs() <= self.threshold) | report['original'].isna(), 'best'] = 'original'
+		report['new_skew'] = [report.loc[col, best] for col, best in report['best'].items()]
+		self.transforms_ = {col: (best, report.loc[col].get(best + '_lambda')) for col, best in report['best'].items() if best != 'original'}
+		self.report_ = report
+		return self
+
+	def transform(self, X):
+		X = X.copy()
+		for col, (name, lmbda) in self.transforms_.items():
+			x = X[col].to_numpy(np.float64)
+			if name == 'log1p':
+				X[col] = np.log1p(x)
+			elif name == 'sqrt':
+				X[col] = np.sqrt(x)
+			elif name == 'boxcox1p':
+				X[col] = boxcox1p_grid(x, np.array([lmbda]))[:, 0]
+			else:
+				X[col] = yeo_johnson_grid(x, np.array([lmbda]))[:, 0]
+		return X
+
+skew_fixer = SkewFixer(threshold=0.5)
+df = skew_fixer.fit_transform(df)
+skew_fixer.report_.sort_values('original', ascending=False)
 
 #Exploratory Data Analysis (EDA)
 sns.pairplot(df, hue='categorical_var')
@@ -350,15 +1137,64 @@ sns.boxplot(df['feature1'])
 sns.boxplot(df['feature2'])
 plt.scatter('var1', 'y') #Do this for all variables against y
 
-def replace_outlier(df, column, value, threshold, direction='max'): #value could be the mean
-		if direction == 'max':
-			df[column] = df[column].apply(lambda x: value if x > threshold else x)
-			for item in df[df[column] > threshold].index:
-				df.loc[item, (column+'_nan')] = 1
-		elif direction == 'min':
-			df[column] = df[column].apply(lambda x: value if x < threshold else x)
-			for item in df[df[column] < threshold].index:
-				df.loc[item, (column+'_nan')] = 1
+#Cap outliers in many columns at once with masks. The thresholds are learned with fit, so the same ones are applied to the test set:
+#method='absolute' uses lower/upper as thresholds (scalars or dicts by column), 'quantile' uses them as quantiles (e.g. 0.01 and 0.99)
+#and 'iqr' uses q25 - k*IQR and q75 + k*IQR. Outliers are set to the threshold, or to value (a number, 'mean' or 'median'),
+#and flagged in column + '_nan' (if it already exists, e.g. from missing data, the flags are combined)
+from sklearn import base
+
+class OutlierCapper(base.BaseEstimator, base.TransformerMixin):
+	def __init__(self, columns=None, method='iqr', lower=None, upper=None, k=1.5, value=None, add_indicator=True):
+		self.columns = columns
+		self.method = method
+		self.lower = lower
+		self.upper = upper
+		self.k = k
+		self.value = value
+		self.add_indicator = add_indicator
+
+	def fit(self, X, y=None):
+		if self.columns is None: #All numeric columns except the existing _nan indicators
+			numeric = X.select_dtypes(include='number').columns
+			self.columns_ = numeric[~numeric.str.endswith('_nan')]
+		else:
+			self.columns_ = pd.Index(self.columns)
+		if self.method == 'absolute':
+			self.lower_ = pd.Series(self.lower, index=self.columns_, dtype=np.float64).fillna(-np.inf)
+			self.upper_ = pd.Series(self.upper, index=self.columns_, dtype=np.float64).fillna(np.inf)
+		elif self.method == 'quantile':
+			q = X[self.columns_].quantile([self.lower if self.lower is not None else 0, self.upper if self.upper is not None else 1])
+			self.lower_, self.upper_ = q.iloc[0], q.iloc[1]
+		elif self.method == 'iqr':
+			q = X[self.columns_].quantile([0.25, 0.75])
+			iqr = q.iloc[1] - q.iloc[0]
+			self.lower_, self.upper_ = q.iloc[0] - self.k * iqr, q.iloc[1] + self.k * iqr
+		else:
+			raise ValueError("method must be 'absolute', 'quantile' or 'iqr'")
+		if self.value in ('mean', 'median'):
+			self.value_ = X[self.columns_].agg(self.value)
+		else:
+			self.value_ = self.value
+		return self
+
+	def transform(self, X):
+		X = X.copy()
+		values = X[self.columns_]
+		outliers = values.lt(self.lower_, axis=1) | values.gt(self.upper_, axis=1)
+		if self.value_ is None:
+			X[self.columns_] = values.clip(self.lower_, self.upper_, axis=1)
+		else:
+			X[self.columns_] = values.mask(outliers, self.value_, axis=1 if isinstance(self.value_, pd.Series) else None)
+		if self.add_indicator:
+			flags = outliers.add_suffix('_nan')
+			existing = flags.columns.intersection(X.columns)
+			flags[existing] = flags[existing] | X[existing].fillna(0).astype(bool)
+			X = pd.concat([X.drop(columns=existing), flags.astype(np.int8)], axis=1)
+		return X
+
+capper = OutlierCapper(columns=['feature1', 'feature2'], method='quantile', lower=0.01, upper=0.99)
+X_train = capper.fit_transform(X_train)
+X_val = capper.transform(X_val)
 
 #Outlier detection with Isolation Forest
 from sklearn.ensemble import IsolationForest
@@ -370,38 +1206,48 @@ outliers = [1 if x == -1 else 0 for x in outliers]
 df['Outlier'] = outliers
 
 #Outlier detection with Mahalanobis Distance
-def is_pos_def(A):
-	if np.allclose(A, A.T):
-		try:
-			np.linalg.cholesky(A)
-			return True
-		except np.linalg.LinAlgError:
-			return False
-	else:
-		return False
-
-def cov_matrix(data):
-	covariance_matrix = np.cov(data, rowvar=False)
-	if is_pos_def(covariance_matrix):
-		inv_covariance_matrix = np.linalg.inv(covariance_matrix)
-		if is_pos_def(inv_covariance_matrix):
-			return covariance_matrix, inv_covariance_matrix
-		else:
-			print('Error: Inverse Covariance Matrix is not positive definite')
-	else:
-		print('Error: Covariance Matrix is not positive definite')
-
-def mahalanobis_distance(inv_covariance_matrix, data):
-		normalized = data - data.mean(axis=0)
-		md = []
-		for i in range(len(normalized)):
-			md.append(np.sqrt(normalized[i].dot(inv_covariance_matrix).dot(normalized[i])))
-		return md
-
+#The covariance matrix is factored once with Cholesky, which also fails if it's not positive definite. The distances of all the rows
+#are computed with triangular solves over chunks of rows: no inverse matrix and no python loop over rows
+from scipy.linalg import solve_triangular
+from scipy.stats import chi2 as chi2_dist #Not chi2: the feature selection section imports sklearn's chi2 test
+from sklearn.covariance import LedoitWolf, MinCovDet
+
+def cov_matrix(data, method='empirical', sample_size=None, random_state=101):
+	""" returns the mean and covariance matrix of data. method can be 'empirical', 'shrinkage' (Ledoit-Wolf)
+		or 'robust' (Minimum Covariance Determinant, use sample_size with big datasets).
+	"""
+	X = np.asarray(data, dtype=np.float64)
+	if sample_size is not None and sample_size < len(X):
+		X = X[np.random.default_rng(random_state).choice(len(X), sample_size, replace=False)]
+	if method == 'empirical':
+		return X.mean(axis=0), np.cov(X, rowvar=False)
+	estimator = LedoitWolf() if method == 'shrinkage' else MinCovDet(random_state=random_state)
+	estimator.fit(X)
+	return estimator.location_, estimator.covariance_
+
+def mahalanobis_distance(data, mean, covariance_matrix, chunksize=1_000_000, regularization=0):
+	#With collinear columns the covariance is singular, regularization adds a small ridge (relative to the mean variance) like OnlineMahalanobis
+	covariance_matrix = np.asarray(covariance_matrix, dtype=np.float64)
+	covariance_matrix = covariance_matrix + regularization * np.trace(covariance_matrix) / len(covariance_matrix) * np.eye(len(covariance_matrix))
+	try:
+		L = np.linalg.cholesky(covariance_matrix)
+	except np.linalg.LinAlgError:
+		raise np.linalg.LinAlgError('Covariance matrix is not positive definite (collinear or constant columns?), drop them or use regularization=1e-6 or method=\'shrinkage\'')
+	X = np.asarray(data, dtype=np.float64)
+	dist = np.empty(len(X))
+	for start in range(0, len(X), chunksize):
+		z = solve_triangular(L, (X[start:start + chunksize] - mean).T, lower=True, check_finite=False)
+		dist[start:start + chunksize] = np.sqrt(np.einsum('ij,ij->j', z, z))
+	return dist
+
+mean, covariance_matrix = cov_matrix(df)
+dist = mahalanobis_distance(df, mean, covariance_matrix)
 #Mahalanobis Distance should follow X2 distribution, let's visualize it:
 sns.distplot(np.square(dist), bins=10, kde=False)
 
-def mahalanobis_distance_threshold(dist, k=2): #k=3 for a higher threshold
+def mahalanobis_distance_threshold(dist, k=2, quantile=None, n_features=None): #k=3 for a higher threshold
+	if quantile is not None: #Squared distances follow a X2 distribution with n_features degrees of freedom
+		return np.sqrt(chi2_dist.ppf(quantile, n_features))
 	return np.mean(dist)*k
 
 #Visualize the Mahalanobis distance to check if the threshold is reasonable
@@ -409,53 +1255,222 @@ sns.distplot(dist, bins=10, kde=True)
 
 def mahalanobis_distance_detect_outliers(dist, k=2):
 	threshold = mahalanobis_distance_threshold(dist, k)
-	outliers = []
-	for i in range(len(dist)):
-		if dist[i] >= threshold:
-			outliers.append(i) #index of the outlier
-	return np.array(outliers)
-
-md = mahalanobis_distance_detect_outliers(mahalanobis_distance(cov_matrix(df)[1], df), k=2)
-#Flag outliers with Mahalanobis Distance
-threshold = mahalanobis_distance_threshold(mahalanobis_distance(cov_matrix(df)[1], df), k=2)
-outlier = pd.DataFrame({'Mahalanobis distance': md, 'Threshold':threshold})
-outlier['Outlier'] = outlier[outlier['Mahalanobis distance'] > outlier['Threshold']]
-df['Outlier'] = outlier['Outlier']
+	return np.flatnonzero(dist >= threshold) #index of the outliers
+
+md = mahalanobis_distance_detect_outliers(dist, k=2)
+#Flag outliers with Mahalanobis Distance. Returns the distances, the threshold and the flags as arrays
+def mahalanobis_outliers(data, method='empirical', k=2, quantile=None, sample_size=None, chunksize=1_000_000, regularization=0):
+	mean, covariance_matrix = cov_matrix(data, method, sample_size)
+	dist = mahalanobis_distance(data, mean, covariance_matrix, chunksize, regularization)
+	threshold = mahalanobis_distance_threshold(dist, k, quantile, len(mean))
+	return dist, threshold, dist > threshold
+
+dist, threshold, outliers = mahalanobis_outliers(df, method='robust', quantile=0.975, sample_size=100_000)
+df['Outlier'] = outliers.astype(int)
+#Online outlier detection with Mahalanobis Distance for streams. Mean and covariance are updated with every micro-batch (Welford's
+#algorithm for batches) instead of being refitted on the full history. With decay < 1 old data is forgotten: after each row the weight
+#of the previous state is multiplied by decay. Each batch is scored against the state before adding it
+class OnlineMahalanobis:
+	def __init__(self, n_features, decay=1.0, regularization=1e-6):
+		self.decay = decay
+		self.regularization = regularization
+		self.weight = 0.0
+		self.mean = np.zeros(n_features)
+		self.m2 = np.zeros((n_features, n_features)) #Sum of the outer products of the deviations from the mean
+		self.L = None
+
+	def partial_fit(self, X):
+		X = np.asarray(X, dtype=np.float64)
+		if len(X) == 0:
+			return self
+		#The rows of the batch are weighted as if they had been added one by one, so the result doesn't depend on the batch size
+		row_weights = self.decay**np.arange(len(X) - 1, -1, -1, dtype=np.float64)
+		batch_weight = row_weights.sum()
+		batch_mean = row_weights @ X / batch_weight
+		centered = X - batch_mean
+		self.weight *= self.decay**len(X)
+		self.m2 *= self.decay**len(X)
+		total = self.weight + batch_weight
+		delta = batch_mean - self.mean
+		self.m2 += (centered * row_weights[:, None]).T @ centered + np.outer(delta, delta) * self.weight * batch_weight / total
+		self.mean += delta * batch_weight / total
+		self.weight = total
+		self.L = None #The Cholesky factor is recomputed on the next score
+		return self
+
+	def covariance(self):
+		return self.m2 / max(self.weight - 1, 1)
+
+	def score(self, X):
+		if self.weight <= len(self.mean): #Not enough data yet
+			return np.full(len(X), np.nan)
+		if self.L is None:
+			covariance = self.covariance()
+			self.L = np.linalg.cholesky(covariance + self.regularization * np.trace(covariance) / len(self.mean) * np.eye(len(self.mean)))
+		z = solve_triangular(self.L, (np.asarray(X, dtype=np.float64) - self.mean).T, lower=True, check_finite=False)
+		return np.sqrt(np.einsum('ij,ij->j', z, z))
+
+	def score_and_update(self, X, quantile=0.999, update_with_outliers=False):
+		X = np.asarray(X, dtype=np.float64)
+		dist = self.score(X)
+		outliers = dist > np.sqrt(chi2_dist.ppf(quantile, len(self.mean)))
+		self.partial_fit(X if update_with_outliers else X[~outliers])
+		return dist, outliers
+
+	def snapshot(self):
+		return {'decay': self.decay, 'regularization': self.regularization, 'weight': self.weight, 'mean': self.mean.copy(), 'm2': self.m2.copy()}
+
+	@classmethod
+	def restore(cls, state):
+		detector = cls(len(state['mean']), float(state['decay']), float(state['regularization']))
+		detector.weight = float(state['weight'])
+		detector.mean = np.array(state['mean'], dtype=np.float64)
+		detector.m2 = np.array(state['m2'], dtype=np.float64)
+		return detector
+
+def benchmark_online_detector(n_features=20, batch_size=1000, n_batches=1000, decay=0.9999):
+	rng = np.random.default_rng(101)
+	batches = rng.normal(size=(10, batch_size, n_features))
+	detector = OnlineMahalanobis(n_features, decay).partial_fit(batches[0])
+	start = time.perf_counter()
+	for i in range(n_batches):
+		detector.score_and_update(batches[i % len(batches)])
+	elapsed = time.perf_counter() - start
+	print('{:,.0f} rows/s, {:.3f} ms per batch of {} rows'.format(n_batches * batch_size / elapsed, 1000 * elapsed / n_batches, batch_size))
+
+detector = OnlineMahalanobis(n_features=df.shape[1], decay=0.9999).partial_fit(df) #Warm up with historical data
+for batch in stream: #e.g. read_csv_chunked('new_data.csv', chunksize=1000)
+	dist, outliers = detector.score_and_update(batch)
+np.savez('detector.npz', **detector.snapshot())
+detector = OnlineMahalanobis.restore(np.load('detector.npz'))
+benchmark_online_detector()
 
 #Correlation analysis
 sns.heatmap(df.corr(), annot=True, fmt='.2f')
 correlations = df.corr(method='pearson').abs().unstack().sort_values(kind="quicksort").reset_index()
 correlations = correlations[correlations['level_0'] != correlations['level_1']]
+#With many features the full correlation matrix doesn't fit in memory. Standardize the columns once (ranks for spearman) and compute
+#the correlations block of columns by block with matrix products, keeping only the pairs above threshold or the top k of every feature.
+#Memory is proportional to p*k instead of p². Columns must not have missing values
+corr_data = None
+
+def set_corr_data(Z):
+	global corr_data
+	corr_data = Z
+
+def corr_block(start, stop, threshold=0.9, k=None, Z=None):
+	Z = corr_data if Z is None else Z
+	rows = np.arange(stop - start)
+	if k is not None:
+		k = min(k, Z.shape[1] - 1) #Every feature has only p - 1 partners
+		c = Z[:, start:stop].T @ Z
+		strength = np.abs(c)
+		strength[rows, rows + start] = -1 #The correlation of each feature with itself is never picked
+		idx = np.argpartition(-strength, k - 1, axis=1)[:, :k] if k > 0 else np.empty((len(rows), 0), dtype=np.int64)
+		return rows.repeat(k) + start, idx.ravel(), np.take_along_axis(c, idx, axis=1).ravel()
+	c = Z[:, start:stop].T @ Z[:, start:] #Only the pairs (i, j) with j > i
+	i, j = np.nonzero((np.abs(c) >= threshold) & (np.arange(c.shape[1])[None, :] > rows[:, None]))
+	return i + start, j + start, c[i, j]
+
+def top_correlations(df, threshold=0.9, k=None, method='pearson', block_size=1024, n_jobs=1, dtype=np.float32):
+	X = (df.rank() if method == 'spearman' else df).to_numpy(dtype, copy=True)
+	X -= X.mean(axis=0)
+	norms = np.linalg.norm(X, axis=0)
+	X /= np.where(norms > 0, norms, np.inf) #Constant columns have correlation 0 with everything
+	starts = list(range(0, X.shape[1], block_size))
+	stops = [min(start + block_size, X.shape[1]) for start in starts]
+	if n_jobs == 1:
+		results = [corr_block(start, stop, threshold, k, X) for start, stop in zip(starts, stops)]
+	else:
+		with ProcessPoolExecutor(max_workers=n_jobs, initializer=set_corr_data, initargs=(X,)) as executor:
+			results = list(executor.map(corr_block, starts, stops, repeat(threshold), repeat(k)))
+	i, j, corr = (np.concatenate(r) for r in zip(*results))
+	correlations = pd.DataFrame({'level_0': df.columns[i], 'level_1': df.columns[j], 'corr': corr})
+	return correlations.iloc[np.argsort(-np.abs(corr), kind='stable')].reset_index(drop=True)
+
+correlations = top_correlations(df, threshold=0.9)
+correlations = top_correlations(df, k=10, method='spearman', n_jobs=8) #The 10 most correlated features of every feature
 
 #Colinearity
-from statsmodels.stats.outliers_influence import variance_inflation_factor    
+#The VIF of every column is the diagonal of the inverse of the correlation matrix, so they're all computed at once instead of fitting a
+#regression per column. When a column is dropped, the inverse of the remaining columns is updated with a rank-one downdate (Schur complement)
 def calculate_vif_(X, thresh=5.0):
-	variables = list(range(X.shape[1]))
-	dropped = True
-	while dropped:
-		dropped = False
-		vif = [variance_inflation_factor(X.iloc[:, variables].values, ix)
-			   for ix in range(X.iloc[:, variables].shape[1])]
-
-		maxloc = vif.index(max(vif))
-		if max(vif) > thresh:
-			print('vif ' + vif + ' dropping \'' + X.iloc[:, variables].columns[maxloc] +
-				  '\' at index: ' + str(maxloc))
-			del variables[maxloc]
-			dropped = True
+	values = X.to_numpy(dtype=np.float64)
+	constant = values.std(axis=0) == 0
+	dropped = [(col, np.nan, 'constant') for col in X.columns[constant]] #Their VIF is not defined
+	variables = list(np.flatnonzero(~constant))
+	corr = np.corrcoef(values[:, variables], rowvar=False)
+	try:
+		inv_corr = np.linalg.inv(corr)
+	except np.linalg.LinAlgError: #Perfectly collinear columns, they'll get a huge VIF
+		inv_corr = np.linalg.inv(corr + 1e-10 * np.eye(len(corr)))
+	while len(variables) > 1:
+		vif = np.diag(inv_corr)
+		maxloc = int(np.argmax(vif))
+		if vif[maxloc] <= thresh:
+			break
+		print('vif {:.2f} dropping \'{}\' at index: {}'.format(vif[maxloc], X.columns[variables[maxloc]], maxloc))
+		dropped.append((X.columns[variables[maxloc]], vif[maxloc], 'vif > {}'.format(thresh)))
+		keep = np.arange(len(variables)) != maxloc
+		inv_corr = inv_corr[np.ix_(keep, keep)] - np.outer(inv_corr[keep, maxloc], inv_corr[maxloc, keep]) / inv_corr[maxloc, maxloc]
+		del variables[maxloc]
 
 	print('Remaining variables:')
 	print(X.columns[variables])
-	return X.iloc[:, variables]
+	return X.iloc[:, variables], pd.DataFrame(dropped, columns=['column', 'vif', 'reason'])
+
+X, vif_dropped = calculate_vif_(X, thresh=5.0)
 
 #Encode categorical variables
 #Encoding for target variable (categorical variable)
 from sklearn.preprocessing import LabelEncoder
 le = LabelEncoder()
 df['categorical_var'] = le.fit_transform(df['categorical_var'])
-#Check for new categories in the validation/test set
-X_val[col] = X_val[col].apply(lambda x: 'new_category' if x not in le.classes_ else x)
-le.classes_ = np.append(le.classes_, 'new_category')
+#Check for new categories in the validation/test set. A vocabulary with the categories seen in train maps whole columns to integer codes
+#with one hash lookup (pd.Index.get_indexer) instead of a membership test per row. Code 0 is reserved for categories not in the vocabulary.
+#With grow=True new categories get new codes instead, existing codes never change. Columns with the same kind of values can share
+#a vocabulary, e.g. shared={'work_city': 'home_city'}. Save it with pickle to use the same codes in production
+class CategoryVocabulary:
+	def __init__(self, shared=None):
+		self.shared = shared or {}
+		self.vocabularies = {}
+
+	def add(self, col, values):
+		name = self.shared.get(col, col)
+		vocabulary = self.vocabularies.get(name, pd.Index([], dtype=object))
+		new = pd.Index(pd.unique(values))
+		self.vocabularies[name] = vocabulary.append(new[vocabulary.get_indexer(new) < 0])
+
+	def fit(self, df, columns):
+		for col in columns:
+			self.add(col, df[col])
+		return self
+
+	def lookup(self, col, s):
+		vocabulary = self.vocabularies.get(self.shared.get(col, col), pd.Index([], dtype=object))
+		if isinstance(s.dtype, pd.CategoricalDtype): #Only the categories need to be looked up
+			category_codes = np.r_[vocabulary.get_indexer(s.cat.categories), vocabulary.get_indexer([np.nan])]
+			return category_codes[s.cat.codes]
+		return vocabulary.get_indexer(s)
+
+	def transform(self, df, columns, grow=False):
+		codes = {}
+		for col in columns:
+			if grow:
+				self.add(col, df[col])
+			codes[col] = (self.lookup(col, df[col]) + 1).astype(np.int32)
+		return pd.DataFrame(codes, index=df.index)
+
+	def inverse_transform(self, codes, col):
+		vocabulary = self.vocabularies[self.shared.get(col, col)]
+		return pd.Series(np.r_[np.array([None], dtype=object), vocabulary.to_numpy(dtype=object)][codes], index=getattr(codes, 'index', None))
+
+vocabulary = CategoryVocabulary().fit(X_train, cat_cols)
+X_train[cat_cols] = vocabulary.transform(X_train, cat_cols)
+X_val[cat_cols] = vocabulary.transform(X_val, cat_cols) #New categories get code 0
+X_new_day[cat_cols] = vocabulary.transform(X_new_day, cat_cols, grow=True)
+import pickle
+pickle.dump(vocabulary, open('vocabulary.pkl', 'wb'))
 
 #One hot encoding for categorical information
 #Use sklearn's OneHotEncoder for categories encoded as possitive real numbers
@@ -474,6 +1489,49 @@ num_X_val = X_val.drop(low_cardinality_cols, axis=1)
 OH_X_train = pd.concat([num_X_train, OH_cols_train], axis=1)
 OH_X_val = pd.concat([num_X_valid, OH_cols_val], axis=1)
 
+#Sparse one hot encoding for high cardinality columns. The CSR matrix is built straight from the integer codes of CategoryVocabulary
+#(code 0 = unseen category gets no column, like handle_unknown='ignore'), so the memory is proportional to the nonzeros: 8 bytes per row and column
+#for float32 data and int32 indices. The scaled numeric columns are stacked as sparse too and everything after accepts CSR:
+#StandardScaler(with_mean=False), VarianceThreshold, SelectKBest with f_classif (chi2 only on the one hot block, it rejects the negative scaled values), LogisticRegression(solver='saga'/'liblinear'), SGDClassifier, Ridge...
+#Don't call .toarray()/.todense() or pd.DataFrame on the result
+import scipy.sparse as sp
+
+def one_hot_csr(codes, sizes, dtype=np.float32):
+	codes = np.asarray(codes, dtype=np.int64).reshape(len(codes), -1)
+	offsets = np.r_[0, np.cumsum(sizes)[:-1]] - 1
+	known = codes > 0
+	indices = (codes + offsets)[known] #Row by row, so the indices of every row are already sorted
+	indptr = np.r_[0, np.cumsum(known.sum(axis=1))]
+	return sp.csr_matrix((np.ones(len(indices), dtype=dtype), indices.astype(np.int32), indptr), shape=(len(codes), int(np.sum(sizes))))
+
+def sparse_design_matrix(df, cat_cols, num_cols, vocabulary, scaler=None, dtype=np.float32):
+	sizes = [len(vocabulary.vocabularies[vocabulary.shared.get(col, col)]) for col in cat_cols]
+	X_cat = one_hot_csr(vocabulary.transform(df, cat_cols).to_numpy(), sizes, dtype)
+	X_num = df[num_cols].to_numpy(dtype=dtype)
+	if scaler is not None:
+		X_num = scaler.transform(X_num).astype(dtype)
+	feature_names = list(num_cols) + [col + '_' + str(value) for col, size in zip(cat_cols, sizes) for value in vocabulary.vocabularies[vocabulary.shared.get(col, col)][:size]]
+	return sp.hstack([sp.csr_matrix(X_num), X_cat], format='csr'), feature_names
+
+from sklearn.preprocessing import StandardScaler
+from sklearn.feature_selection import VarianceThreshold, SelectKBest, f_classif
+from sklearn.linear_model import LogisticRegression
+vocabulary = CategoryVocabulary().fit(X_train, cat_cols)
+scaler = StandardScaler().fit(X_train[num_cols])
+X_train_sparse, feature_names = sparse_design_matrix(X_train, cat_cols, num_cols, vocabulary, scaler)
+X_val_sparse, _ = sparse_design_matrix(X_val, cat_cols, num_cols, vocabulary, scaler)
+print('{:.1f} MB'.format((X_train_sparse.data.nbytes + X_train_sparse.indices.nbytes + X_train_sparse.indptr.nbytes) / 1024**2))
+selector = VarianceThreshold(threshold=1e-5).fit(X_train_sparse) #Drops categories that (almost) never appear
+kbest = SelectKBest(f_classif, k=20000).fit(selector.transform(X_train_sparse), y_train)
+X_train_selected = kbest.transform(selector.transform(X_train_sparse))
+X_val_selected = kbest.transform(selector.transform(X_val_sparse))
+selected_features = np.array(feature_names)[selector.get_support()][kbest.get_support()]
+logmodel = LogisticRegression(solver='saga', max_iter=200).fit(X_train_selected, y_train)
+#The same with sklearn only: OneHotEncoder returns CSR by default (sparse_output=True), never pass sparse=False for many categories
+from sklearn.preprocessing import OneHotEncoder
+ohe = OneHotEncoder(handle_unknown='ignore', dtype=np.float32)
+X_train_sparse = sp.hstack([sp.csr_matrix(scaler.transform(X_train[num_cols])), ohe.fit_transform(X_train[cat_cols])], format='csr')
+
 #Use pandas get_dummies for categories encoded as strings
 pd.get_dummies(df, columns=['col1','col2'])
 
@@ -510,6 +1568,162 @@ from category_encoders import CatBoostEncoder
 cbe = CatBoostEncoder(cols=['col1', 'col2', 'col3'])
 cbe.fit(df[['col1', 'col2', 'col3']], df['target'])
 
+#Streaming count/target/CatBoost encoding without category_encoders, for data that doesn't fit in memory or that arrives every day.
+#The statistics of every column are kept in a table of sorted 64 bit hashes of the categories with their counts and target sums (24 bytes per
+#category), partial_fit merges the statistics of a new chunk into it and transform looks up a whole chunk at once with searchsorted.
+#kind='count' gives the counts, kind='target' (sum + smoothing*mean) / (count + smoothing) and kind='ordered' does the CatBoost encoding:
+#partial_fit_transform encodes every train row only with the rows before it (in previous chunks and in the same chunk), then updates the statistics
+from sklearn import base
+
+class CategoryStats:
+	def __init__(self):
+		self.keys = np.empty(0, dtype=np.uint64)
+		self.counts = np.empty(0, dtype=np.int64)
+		self.sums = np.empty(0, dtype=np.float64)
+
+	@staticmethod
+	def hash_values(values):
+		#The same value gets the same key whatever the dtype of the chunk (read_csv reads an integer column as float if the chunk has a NaN):
+		#floats are hashed as float64, integral ones as integers, and every missing value gets the same key
+		s = pd.Series(values)
+		if pd.api.types.is_object_dtype(s):
+			s = s.infer_objects() #An object column of numbers gets the keys of the numbers
+			if pd.api.types.is_object_dtype(s): #Numbers mixed with strings: the numbers are hashed like a float column
+				numeric = s.map(lambda v: isinstance(v, (int, float, np.number)) and not isinstance(v, (bool, np.bool_))).to_numpy(dtype=bool)
+				hashes = pd.util.hash_pandas_object(s, index=False).to_numpy().copy()
+				hashes[numeric] = CategoryStats.hash_values(s[numeric].astype(np.float64))
+				hashes[s.isna().to_numpy()] = 2**64 - 1
+				return hashes
+		if isinstance(s.dtype, pd.CategoricalDtype): #Only the categories need to be hashed
+			return np.r_[CategoryStats.hash_values(s.cat.categories), np.uint64(2**64 - 1)][s.cat.codes]
+		if pd.api.types.is_float_dtype(s):
+			x = s.to_numpy(dtype=np.float64, na_value=np.nan)
+			hashes = pd.util.hash_pandas_object(pd.Series(x), index=False).to_numpy().copy()
+			with np.errstate(invalid='ignore'):
+				integral = (x == np.round(x)) & (np.abs(x) < 2**63)
+			hashes[integral] = pd.util.hash_pandas_object(pd.Series(x[integral].astype(np.int64)), index=False).to_numpy()
+		else:
+			hashes = pd.util.hash_pandas_object(s, index=False).to_numpy().copy()
+		hashes[s.isna().to_numpy()] = 2**64 - 1
+		return hashes
+
+	@staticmethod
+	def group(keys, counts, sums):
+		order = np.argsort(keys, kind='stable')
+		keys = keys[order]
+		starts = np.flatnonzero(np.r_[True, keys[1:] != keys[:-1]])
+		return keys[starts], np.add.reduceat(counts[order], starts), np.add.reduceat(sums[order], starts)
+
+	def update(self, hashes, y=None):
+		if len(hashes) == 0:
+			return self
+		y = np.zeros(len(hashes)) if y is None else np.asarray(y, dtype=np.float64)
+		self.keys, self.counts, self.sums = self.group(np.r_[self.keys, hashes], np.r_[self.counts, np.ones(len(hashes), dtype=np.int64)], np.r_[self.sums, y])
+		return self
+
+	def lookup(self, hashes):
+		#Counts and target sums of every hash, 0 for unseen categories
+		counts, sums = np.zeros(len(hashes), dtype=np.int64), np.zeros(len(hashes))
+		if len(self.keys):
+			idx = np.minimum(np.searchsorted(self.keys, hashes), len(self.keys) - 1)
+			found = self.keys[idx] == hashes
+			counts[found], sums[found] = self.counts[idx[found]], self.sums[idx[found]]
+		return counts, sums
+
+class StreamingEncoder(base.BaseEstimator, base.TransformerMixin):
+	def __init__(self, columns, kind='target', smoothing=1.0):
+		self.columns = columns
+		self.kind = kind
+		self.smoothing = smoothing
+
+	def partial_fit(self, X, y=None):
+		if not hasattr(self, 'tables_'):
+			self.tables_ = {col: CategoryStats() for col in self.columns}
+			self.n_, self.sum_ = 0, 0.0
+		if self.kind != 'count':
+			y = np.asarray(y, dtype=np.float64)
+			self.n_ += len(y)
+			self.sum_ += y.sum()
+		for col in self.columns:
+			self.tables_[col].update(CategoryStats.hash_values(X[col]), y)
+		return self
+
+	def fit(self, X, y=None):
+		if hasattr(self, 'tables_'):
+			del self.tables_
+		return self.partial_fit(X, y)
+
+	def encode(self, counts, sums):
+		if self.kind == 'count':
+			return counts
+		prior = self.sum_ / max(self.n_, 1)
+		return (sums + self.smoothing * prior) / (counts + self.smoothing)
+
+	def transform(self, X):
+		encoded = {}
+		for col in self.columns:
+			encoded[col] = self.encode(*self.tables_[col].lookup(CategoryStats.hash_values(X[col])))
+		return pd.DataFrame(encoded, index=X.index)
+
+	def partial_fit_transform(self, X, y):
+		#Only for kind='ordered' on train chunks (in time order if there is one). The prior is the target mean including this chunk
+		if not hasattr(self, 'tables_'):
+			self.tables_ = {col: CategoryStats() for col in self.columns}
+			self.n_, self.sum_ = 0, 0.0
+		y = np.asarray(y, dtype=np.float64)
+		self.n_ += len(y)
+		self.sum_ += y.sum()
+		encoded = {}
+		for col in self.columns:
+			table = self.tables_[col]
+			hashes = CategoryStats.hash_values(X[col])
+			#Count and target sum of the previous rows of the same category inside the chunk
+			order = np.argsort(hashes, kind='stable')
+			sorted_hashes = hashes[order]
+			new_group = np.r_[True, sorted_hashes[1:] != sorted_hashes[:-1]]
+			starts = np.flatnonzero(new_group)
+			group_start = starts[np.cumsum(new_group) - 1]
+			cum_sums = np.r_[0.0, np.cumsum(y[order])]
+			counts, sums = np.empty(len(y)), np.empty(len(y))
+			counts[order] = np.arange(len(y)) - group_start
+			sums[order] = cum_sums[:-1] - cum_sums[group_start]
+			previous_counts, previous_sums = table.lookup(hashes)
+			encoded[col] = self.encode(counts + previous_counts, sums + previous_sums)
+			table.update(hashes, y)
+		return pd.DataFrame(encoded, index=X.index)
+
+	def fit_transform(self, X, y=None):
+		if self.kind == 'ordered':
+			if hasattr(self, 'tables_'):
+				del self.tables_
+			return self.partial_fit_transform(X, y)
+		return self.fit(X, y).transform(X)
+
+cols = ['col1', 'col2', 'col3']
+count_encoder = StreamingEncoder(cols, kind='count')
+target_encoder = StreamingEncoder(cols, kind='target', smoothing=10)
+for chunk in pd.read_csv('data.csv', usecols=cols + ['target'], chunksize=1_000_000):
+	count_encoder.partial_fit(chunk)
+	target_encoder.partial_fit(chunk, chunk['target'])
+X_CE = count_encoder.transform(df[cols]).add_suffix('_CE')
+X_TE = target_encoder.transform(df[cols]).add_suffix('_TE')
+#CatBoost encoding of the train chunks while streaming, the validation/test data uses the statistics of all train data
+catboost_encoder = StreamingEncoder(cols, kind='ordered', smoothing=1.0)
+for i, chunk in enumerate(pd.read_csv('train.csv', chunksize=1_000_000)):
+	catboost_encoder.partial_fit_transform(chunk[cols], chunk['target']).add_suffix('_CBE').to_parquet('train_cbe_{}.parquet'.format(i))
+X_val_CBE = catboost_encoder.transform(X_val[cols]).add_suffix('_CBE')
+#Refresh daily with the new data only and save the tables
+target_encoder.partial_fit(df_new_day, df_new_day['target'])
+pickle.dump(target_encoder, open('target_encoder.pkl', 'wb'))
+#Check that chunks of the same column with different dtypes (int, float with NaN, Int64, category, object) share the statistics
+check_encoder = StreamingEncoder(['c'], kind='count')
+for chunk in [pd.DataFrame({'c': [1, 1, 2]}), pd.DataFrame({'c': [1, np.nan]}), pd.DataFrame({'c': pd.array([2, None], dtype='Int64')}),
+	pd.DataFrame({'c': pd.Categorical([1, None])}), pd.DataFrame({'c': np.array([1.0, 2.5], dtype=np.float32)}),
+	pd.DataFrame({'c': pd.Series([1, None], dtype=object)}), pd.DataFrame({'c': pd.Series([2, 'a'], dtype=object)})]:
+	check_encoder.partial_fit(chunk)
+assert check_encoder.transform(pd.DataFrame({'c': [1, 2, np.nan, 2.5, 3, 'a']}))['c'].tolist() == [6, 3, 4, 1, 0, 1]
+
+
 #Resampling Methods for Unbalanced Datasets https://towardsdatascience.com/https-towardsdatascience-com-resampling-methods-for-unbalanced-datasets-5b565d0a247d
 #Undersampling the majority class is taking random draws of the dominating class out of the dataset to match the amount of non-dominating class. As a general rule, this is usually the least desirable approach as it causes us to lose some valuable data by throwing it away, but when you have a large dataset, it might prove to be computationally better to undersample.
 #Oversampling the minority class is the opposite. Instead of the previous approach, we take random draws of the non-dominating class and create “fake” copies to match the amount of cases in the dominating class. In this case, we are in essence creating duplicates of the data and training our model on such. This may not be an ideal approach when our non-dominating class is not scattered across the dataset. Duplication will effectively only recreate similar instances without a “synthetic” variety.
@@ -565,6 +1779,83 @@ df['dayofweek_cos'] = np.cos(2 * np.pi * df['dayofweek'] / cycle)
 #Aggregate features into promising new features (x*y)
 #Combine categorical variables
 df['col1_col2'] = df['col1'] + '_' + df['col2']
+#Faster and lighter for many rows/crosses: cross the integer codes instead of the strings. Every column is factorized once, the codes of a cross
+#are combined in mixed radix (code1 * n2 + code2 ...) or with a 64 bit hash if the product of the cardinalities doesn't fit, and the combinations
+#seen at least min_count times in fit get codes 1..k (0 = rare or unseen combination, same as CategoryVocabulary). Without crosses all the pairs are made
+from itertools import combinations
+from sklearn import base
+
+class FeatureCrosser(base.BaseEstimator, base.TransformerMixin):
+	def __init__(self, columns, crosses=None, min_count=1):
+		self.columns = columns
+		self.crosses = crosses
+		self.min_count = min_count
+
+	def column_codes(self, X):
+		return {col: self.categories_[col].get_indexer(X[col]).astype(np.int64) + 1 for col in self.categories_}
+
+	def cross_keys(self, codes, cross):
+		sizes = [len(self.categories_[col]) + 1 for col in cross]
+		keys = codes[cross[0]].copy()
+		if np.prod(np.array(sizes, dtype=np.float64)) < 2**63:
+			for col, size in zip(cross[1:], sizes[1:]):
+				keys = keys * size + codes[col]
+			return keys
+		keys = keys.astype(np.uint64)
+		for col in cross[1:]:
+			keys = (keys ^ codes[col].astype(np.uint64)) * np.uint64(0x9E3779B97F4A7C15)
+		return keys
+
+	def fit(self, X, y=None):
+		self.fit_transform(X)
+		return self
+
+	def fit_transform(self, X, y=None):
+		self.crosses_ = [tuple(cross) for cross in (self.crosses or combinations(self.columns, 2))]
+		self.categories_, codes = {}, {}
+		for col in dict.fromkeys(col for cross in self.crosses_ for col in cross):
+			codes[col], uniques = pd.factorize(X[col], use_na_sentinel=False) #NaN is a category, code 0 is only for unseen values
+			codes[col] = codes[col].astype(np.int64) + 1
+			self.categories_[col] = pd.Index(uniques)
+		self.keys_ = {}
+		crossed = {}
+		for cross in self.crosses_:
+			keys = self.cross_keys(codes, cross)
+			if keys.dtype == np.int64 and keys.max() < 4 * len(keys): #Few combinations, no need to hash them
+				counts = np.bincount(keys)
+				self.keys_[cross] = np.flatnonzero(counts >= max(self.min_count, 1))
+				new_codes = np.zeros(len(counts), dtype=np.int32)
+				new_codes[self.keys_[cross]] = np.arange(1, len(self.keys_[cross]) + 1)
+				crossed['_'.join(cross)] = new_codes[keys]
+				continue
+			inverse, keys = pd.factorize(keys)
+			keep = np.bincount(inverse) >= self.min_count
+			self.keys_[cross] = np.sort(keys[keep])
+			#Codes sorted like the keys so transform gives the same codes
+			new_codes = np.zeros(len(keys), dtype=np.int32)
+			new_codes[keep] = np.searchsorted(self.keys_[cross], keys[keep]) + 1
+			crossed['_'.join(cross)] = new_codes[inverse]
+		return pd.DataFrame(crossed, index=X.index)
+
+	def transform(self, X):
+		codes = self.column_codes(X)
+		crossed = {}
+		for cross in self.crosses_:
+			keys = self.cross_keys(codes, cross)
+			known = self.keys_[cross]
+			crossed_codes = np.zeros(len(keys), dtype=np.int32)
+			if len(known):
+				idx = np.minimum(np.searchsorted(known, keys), len(known) - 1)
+				found = known[idx] == keys
+				crossed_codes[found] = idx[found] + 1
+			crossed['_'.join(cross)] = crossed_codes
+		return pd.DataFrame(crossed, index=X.index)
+
+crosser = FeatureCrosser(['col1', 'col2', 'col3'], min_count=20) #col1_col2, col1_col3, col2_col3
+X_train = X_train.join(crosser.fit_transform(X_train))
+crosser = FeatureCrosser(['col1', 'col2', 'col3'], crosses=[('col1', 'col2'), ('col1', 'col2', 'col3')])
+df = df.join(crosser.fit_transform(df))
+X_val = X_val.join(crosser.transform(X_val))
 #For speed/movement data, add vectorial features. Try many different combinations
 df['position_norm'] = df['position_X'] ** 2 + df['position_Y'] ** 2 + df['position_Z'] ** 2
 df['position_module'] = df['position_norm'] ** 0.5
@@ -660,6 +1951,415 @@ for column in tqdm(df.columns):
 	df_tmp[column + '_neg_freq'] = df[df[column] < 0].shape[0]
 	df_tmp[column + '_nzeros'] = (df[column]==0).sum(axis=0)
 df = df_tmp.copy()
+
+#Same features much faster for big tables: series_id is factorized and sorted once, every series becomes a contiguous segment between two
+#offsets and all the statistics of a column are computed for all the series at the same time with reduceat (quantiles with one sort inside the
+#segments). Gives the same columns and names as the loop above (mean absolute deviation for median_abs_dev like pandas' mad). Fill missing values before
+def segment_offsets(keys):
+	codes, ids = pd.factorize(keys, sort=True)
+	order = np.argsort(codes, kind='stable')
+	offsets = np.r_[0, np.cumsum(np.bincount(codes, minlength=len(ids)))]
+	return order, offsets, ids
+
+def segment_stats(x, offsets, value_order=None):
+	x = np.asarray(x, dtype=np.float64)
+	value_order = np.argsort(x) if value_order is None else value_order
+	starts, n = offsets[:-1], np.diff(offsets)
+	segment = np.repeat(np.arange(len(n)), n)
+	def seg_sum(values):
+		return np.add.reduceat(values, starts)
+	stats = {}
+	stats['mean'] = seg_sum(x) / n
+	centered = x - stats['mean'][segment]
+	centered2 = centered * centered
+	m2, m3, m4 = seg_sum(centered2) / n, seg_sum(centered2 * centered) / n, seg_sum(centered2 * centered2) / n
+	with np.errstate(invalid='ignore', divide='ignore'):
+		#Sorted inside every segment: sort by segment and rank of the value, both packed in one int64
+		rank = np.empty(len(x), dtype=np.int64)
+		rank[value_order] = np.arange(len(x))
+		sorted_x = x[value_order][np.sort(segment * len(x) + rank) % len(x)]
+		def quantile(q):
+			pos = starts + q * (n - 1)
+			lo = np.floor(pos).astype(np.int64)
+			return sorted_x[lo] + (pos - lo) * (sorted_x[np.minimum(lo + 1, offsets[1:] - 1)] - sorted_x[lo])
+		stats['median'] = quantile(0.5)
+		stats['max'] = np.maximum.reduceat(x, starts)
+		stats['min'] = np.minimum.reduceat(x, starts)
+		stats['std'] = np.sqrt(m2 * n / (n - 1))
+		stats['range'] = stats['max'] - stats['min']
+		stats['max_over_Min'] = stats['max'] / stats['min']
+		stats['median_abs_dev'] = seg_sum(np.abs(centered)) / n
+		abs_diff = np.abs(np.r_[x[1:] - x[:-1], 0.0])
+		abs_diff[offsets[1:] - 1] = 0
+		stats['mean_abs_chg'] = seg_sum(abs_diff) / (n - 1)
+		#The sum of the changes of |diff| telescopes to |last diff| - |first diff|
+		last_abs_diff, first_abs_diff = abs_diff[np.maximum(offsets[1:] - 2, starts)], abs_diff[starts]
+		stats['mean_change_of_abs_change'] = np.where(n > 2, (last_abs_diff - first_abs_diff) / (n - 2), np.nan)
+		abs_x = np.abs(x)
+		stats['abs_max'] = np.maximum.reduceat(abs_x, starts)
+		stats['abs_min'] = np.minimum.reduceat(abs_x, starts)
+		stats['abs_avg'] = (stats['abs_min'] + stats['abs_max']) / 2
+		stats['abs_mean'] = seg_sum(abs_x) / n
+		abs_centered = abs_x - stats['abs_mean'][segment] #Centered like std, the raw sum of squares cancels out on offset data
+		stats['abs_std'] = np.sqrt(seg_sum(abs_centered * abs_centered) / n)
+		stats['abs_range'] = stats['abs_max'] - stats['abs_min']
+		stats['skew'] = np.where((n > 2) & (m2 > 0), np.sqrt(n * (n - 1)) / (n - 2) * m3 / m2 ** 1.5, np.where(n > 2, 0, np.nan))
+		stats['q25'] = quantile(0.25)
+		stats['q75'] = quantile(0.75)
+		stats['q95'] = quantile(0.95)
+		stats['iqr'] = stats['q75'] - stats['q25']
+		stats['CPT5'] = seg_sum(np.exp(x)) / (n * np.exp(np.sqrt(m2)))
+		#SSC, wave_length and zero_crossing wrap around: the next value of the last one is the first one of the series
+		next_x = np.r_[x[1:], 0.0]
+		next_x[offsets[1:] - 1] = x[starts]
+		previous_x = np.r_[0.0, x[:-1]]
+		slope_change = ((x - previous_x) * (x - next_x) > 0).astype(np.float64)
+		slope_change[starts] = 0
+		stats['SSC'] = seg_sum(slope_change)
+		stats['wave_lenght'] = seg_sum(np.abs(next_x - x))
+		stats['norm_entropy'] = seg_sum(abs_x * abs_x * abs_x)
+		stats['SRAV'] = (seg_sum(np.sqrt(abs_x)) / n) ** 2
+		stats['kurtosis'] = m4 / m2 ** 2 - 3
+		stats['zero_crossing'] = seg_sum((-x * next_x > 0).astype(np.float64))
+	return stats
+
+def column_stats(x, value_order=None, row_order=None):
+	#Statistics of the whole column, the same value for every series. row_order gives the original rows if x was reordered
+	x = np.asarray(x, dtype=np.float64)
+	value_order = np.argsort(x) if value_order is None else value_order
+	sorted_x = x[value_order]
+	run_starts = np.flatnonzero(np.r_[True, sorted_x[1:] != sorted_x[:-1]])
+	counts = np.diff(np.r_[run_starts, len(x)])
+	#Most frequent value, the first one to appear if there are ties like value_counts().idxmax()
+	first_rows = np.minimum.reduceat(value_order if row_order is None else row_order[value_order], run_starts)
+	candidates = np.flatnonzero(counts == counts.max())
+	rounded = sorted_x.round(3)
+	return {'unq': 1 + np.count_nonzero(rounded[1:] != rounded[:-1]), 'freq': sorted_x[run_starts[candidates[np.argmin(first_rows[candidates])]]],
+		'max_freq': counts[-1], 'min_freq': counts[0], 'pos_freq': (x >= 0).sum(), 'neg_freq': (x < 0).sum(), 'nzeros': (x == 0).sum()}
+
+def series_features(df, by='series_id', columns=None):
+	columns = [col for col in (columns or df.columns) if col != by]
+	order, offsets, ids = segment_offsets(df[by])
+	features = {}
+	for column in tqdm(columns):
+		x = df[column].to_numpy(dtype=np.float64)[order]
+		value_order = np.argsort(x) #Shared by the quantiles and the column statistics
+		for name, value in segment_stats(x, offsets, value_order).items():
+			features[column + ('' if name == 'median_abs_dev' else '_') + name] = value
+		for name, value in column_stats(x, value_order, order).items():
+			features[column + '_' + name] = np.full(len(ids), value)
+	return pd.DataFrame(features, index=pd.Index(ids, name=by))
+
+df = series_features(df, by='series_id')
+#Compiled version of CPT5, SSC, wave_length, norm_entropy, SRAV, mean_abs, zero_crossing and the diff statistics: one numba kernel goes through
+#the segments of the sorted values (offsets from segment_offsets) without creating any array or Python object per series, in parallel over all the
+#series and columns. values has one row per column (C contiguous) and out is (columns, series, features)
+KERNEL_FEATURES = ['CPT5', 'SSC', 'wave_lenght', 'norm_entropy', 'SRAV', 'mean_abs', 'zero_crossing', 'mean_abs_chg', 'mean_change_of_abs_change']
+
+@numba.njit(parallel=True)
+def segment_kernels(values, offsets, out):
+	n_segments = len(offsets) - 1
+	for task in numba.prange(values.shape[0] * n_segments):
+		c, s = task // n_segments, task % n_segments
+		x = values[c]
+		start, stop = offsets[s], offsets[s + 1]
+		n = stop - start
+		total = 0.0
+		for i in range(start, stop):
+			total += x[i]
+		mean = total / n
+		squares = exp_sum = cube_sum = sqrt_sum = abs_sum = wave = abs_chg = 0.0
+		ssc = zero_crossing = 0
+		for i in range(start, stop):
+			value = x[i]
+			absolute = abs(value)
+			next_value = x[i + 1] if i < stop - 1 else x[start] #The last value wraps around to the first one
+			squares += (value - mean) * (value - mean)
+			exp_sum += np.exp(value)
+			cube_sum += absolute * absolute * absolute
+			sqrt_sum += np.sqrt(absolute)
+			abs_sum += absolute
+			wave += abs(next_value - value)
+			if -value * next_value > 0:
+				zero_crossing += 1
+			if i > start:
+				if (value - x[i - 1]) * (value - next_value) > 0:
+					ssc += 1
+				abs_chg += abs(value - x[i - 1])
+		out[c, s, 0] = exp_sum / (n * np.exp(np.sqrt(squares / n)))
+		out[c, s, 1] = ssc
+		out[c, s, 2] = wave
+		out[c, s, 3] = cube_sum
+		out[c, s, 4] = (sqrt_sum / n) * (sqrt_sum / n)
+		out[c, s, 5] = abs_sum / n
+		out[c, s, 6] = zero_crossing
+		out[c, s, 7] = abs_chg / (n - 1) if n > 1 else np.nan
+		#The changes of |diff| add up to |last diff| - |first diff|
+		out[c, s, 8] = (abs(x[stop - 1] - x[stop - 2]) - abs(x[start + 1] - x[start])) / (n - 2) if n > 2 else np.nan
+
+def kernel_features(df, by='series_id', columns=None):
+	columns = [col for col in (columns or df.columns) if col != by]
+	order, offsets, ids = segment_offsets(df[by])
+	values = np.ascontiguousarray(df[columns].to_numpy(dtype=np.float64)[order].T)
+	out = np.empty((len(columns), len(ids), len(KERNEL_FEATURES)))
+	segment_kernels(values, offsets, out)
+	return pd.DataFrame(out.transpose(1, 0, 2).reshape(len(ids), -1), index=pd.Index(ids, name=by), columns=[col + '_' + name for col in columns for name in KERNEL_FEATURES])
+
+df_kernels = kernel_features(df, by='series_id')
+#Check that the kernels give the same values as the functions above (short series, zeros and repeated values included)
+from numpy.testing import assert_allclose
+rng = np.random.default_rng(101)
+lengths = rng.integers(1, 50, 500)
+df_check = pd.DataFrame({'series_id': np.repeat(rng.permutation(500), lengths), 'x': rng.normal(size=lengths.sum()).round(1)})
+compiled = kernel_features(df_check, by='series_id', columns=['x'])
+for name, function in [('CPT5', CPT5), ('SSC', SSC), ('wave_lenght', wave_length), ('norm_entropy', norm_entropy), ('SRAV', SRAV), ('mean_abs', mean_abs),
+	('zero_crossing', zero_crossing), ('mean_abs_chg', lambda x: np.mean(np.abs(np.diff(x)))), ('mean_change_of_abs_change', lambda x: np.mean(np.diff(np.abs(np.diff(x)))))]:
+	assert_allclose(compiled['x_' + name], df_check.groupby('series_id')['x'].apply(function), rtol=1e-10, atol=1e-12, err_msg=name)
+#Same output as series_features using all the cores. The sorted numeric columns, the offsets and the row order are copied once to shared memory,
+#the workers attach to it by name (nothing big is pickled), compute the features of one column and write them into a shared output block.
+#max_memory (bytes) limits the columns held in shared memory at the same time and the number of workers (each one needs ~16 arrays of the column length)
+#Don't fork the workers from a process that already ran kernel_features: the numba parallel threads don't survive the fork and the workers or the
+#interpreter at exit hang. Run them in separate processes or pass mp_context=multiprocessing.get_context('spawn') from a script (the worker must be importable)
+import multiprocessing
+import os
+from concurrent.futures import ProcessPoolExecutor
+from itertools import repeat
+from multiprocessing import shared_memory
+
+def shared_array(shape, dtype, name=None):
+	size = int(np.prod(shape)) * np.dtype(dtype).itemsize
+	shm = shared_memory.SharedMemory(name=name, create=name is None, size=max(size, 1))
+	return shm, np.ndarray(shape, dtype=dtype, buffer=shm.buf)
+
+def series_features_worker(blocks, c):
+	segments, arrays = zip(*[shared_array(shape, dtype, name) for name, shape, dtype in blocks])
+	values, offsets, order, out = arrays
+	x = values[c]
+	value_order = np.argsort(x)
+	features = list(segment_stats(x, offsets, value_order).values()) + list(column_stats(x, value_order, order).values())
+	out[c] = np.column_stack(np.broadcast_arrays(*features))
+	del values, offsets, order, out, arrays, x
+	for shm in segments:
+		shm.close()
+	return c
+
+def parallel_series_features(df, by='series_id', columns=None, n_jobs=os.cpu_count(), max_memory=8 * 1024**3, mp_context=None):
+	columns = [col for col in (columns or df.columns) if col != by]
+	names = [('' if name == 'median_abs_dev' else '_') + name for name in segment_stats(np.zeros(1), np.array([0, 1]))] + ['_' + name for name in column_stats(np.zeros(1))]
+	order, offsets, ids = segment_offsets(df[by])
+	column_bytes = 8 * len(order) + 8 * len(ids) * len(names)
+	n_jobs = max(1, min(n_jobs, len(columns), int(max_memory // (17 * 8 * len(order) + len(ids) * len(names) * 8))))
+	batch_size = max(n_jobs, int((max_memory - 16 * 8 * len(order) * n_jobs) // column_bytes))
+	features = []
+	with ProcessPoolExecutor(n_jobs, mp_context=mp_context) as executor, tqdm(total=len(columns)) as progress:
+		for batch_start in range(0, len(columns), batch_size):
+			batch = columns[batch_start:batch_start + batch_size]
+			segments, arrays = [], []
+			try:
+				for shape, dtype in [((len(batch), len(order)), np.float64), (offsets.shape, np.int64), (order.shape, np.int64), ((len(batch), len(ids), len(names)), np.float64)]:
+					shm, array = shared_array(shape, dtype)
+					segments.append(shm)
+					arrays.append(array)
+				values, shared_offsets, shared_order, out = arrays
+				for j, col in enumerate(batch):
+					values[j] = df[col].to_numpy(dtype=np.float64)[order]
+				shared_offsets[:], shared_order[:] = offsets, order
+				blocks = [(shm.name, array.shape, array.dtype.str) for shm, array in zip(segments, arrays)]
+				for c in executor.map(series_features_worker, repeat(blocks), range(len(batch))):
+					progress.update(1)
+				features.append(pd.DataFrame(out.transpose(1, 0, 2).reshape(len(ids), -1), columns=[col + name for col in batch for name in names]))
+				del values, shared_offsets, shared_order, out, arrays[:]
+				for shm in segments:
+					shm.close()
+			finally:
+				for shm in segments:
+					shm.unlink()
+	return pd.concat(features, axis=1).set_index(pd.Index(ids, name=by))
+
+df = parallel_series_features(df, by='series_id', n_jobs=64, max_memory=200 * 1024**3)
+#Incremental version of the per series features for live data. Every series/column keeps running sums of the powers of the values and of their
+#absolute values (shifted by the first value to avoid cancellation), monotonic deques for min/max, counters of the pairs/triples for SSC, wave_length and zero_crossing (the wrap
+#around term is added when the features are read) and a sorted window (SortedList) for the quantiles, so a new sample costs O(1) (O(log n) for
+#the quantiles, reading median_abs_dev and CPT5 of a window is O(window)).
+#window=None keeps the whole history with the quantiles from a KLL sketch (approximate), tumbling=True restarts the window every window samples.
+#The names are the same as the batch features above (without the statistics of the whole column: unq, freq, max_freq...)
+from sortedcontainers import SortedList
+from collections import deque
+
+class RollingFeatures:
+	def __init__(self, window=None, error=0.01):
+		self.window = window
+		self.values = deque()
+		self.sorted_values = SortedList()
+		self.sketch = KLL(error) if window is None else None
+		self.pending = [] #Values waiting to be added to the sketch
+		self.max_values, self.min_values, self.abs_max_values, self.abs_min_values = deque(), deque(), deque(), deque()
+		self.n = self.seen = 0
+		self.shift = None
+		self.sums = np.zeros(4) #Sums of (x - shift)**1..4
+		self.abs_sums = np.zeros(2) #Sums of (|x| - |shift|)**1..2
+		self.exp_sum = self.cube_sum = self.sqrt_sum = self.abs_diff_sum = 0.0
+		self.ssc = self.zero_crossing = 0
+		self.first = self.first_abs_diff = None
+		self.last = self.previous = None
+
+	def add_extreme(self, extremes, value, is_better):
+		while extremes and not is_better(extremes[-1][1], value):
+			extremes.pop()
+		extremes.append((self.seen, value))
+
+	def add_sums(self, value, sign):
+		d = value - self.shift
+		absolute = abs(value)
+		self.sums += sign * np.array([d, d * d, d * d * d, d * d * d * d])
+		abs_d = absolute - abs(self.shift)
+		self.abs_sums += sign * np.array([abs_d, abs_d * abs_d])
+		if self.window is None: #With a window it's computed when read, removing exp of big values would leave only rounding errors
+			self.exp_sum += np.exp(value)
+		self.cube_sum += sign * absolute * absolute * absolute
+		self.sqrt_sum += sign * np.sqrt(absolute)
+
+	def update(self, value):
+		value = float(value)
+		if self.shift is None:
+			self.shift = self.first = value
+		if self.last is not None:
+			self.abs_diff_sum += abs(value - self.last)
+			self.zero_crossing += -self.last * value > 0
+			if self.first_abs_diff is None:
+				self.first_abs_diff = abs(value - self.last)
+			if self.previous is not None and self.window != 1: #With window=1 previous already left the window, evict would never remove the triple
+				self.ssc += (self.last - self.previous) * (self.last - value) > 0
+		self.add_sums(value, 1)
+		self.add_extreme(self.max_values, value, lambda old, new: old > new)
+		self.add_extreme(self.min_values, value, lambda old, new: old < new)
+		self.add_extreme(self.abs_max_values, abs(value), lambda old, new: old > new)
+		self.add_extreme(self.abs_min_values, abs(value), lambda old, new: old < new)
+		if self.window is None:
+			self.pending.append(value)
+			if len(self.pending) >= self.sketch.k:
+				self.sketch.update(np.array(self.pending))
+				self.pending = []
+		else:
+			self.values.append(value)
+			self.sorted_values.add(value)
+		self.previous, self.last = self.last, value
+		self.n += 1
+		self.seen += 1
+		if self.window is not None and self.n > self.window:
+			self.evict()
+
+	def evict(self):
+		x0 = self.values.popleft()
+		x1 = self.values[0]
+		self.abs_diff_sum -= abs(x1 - x0)
+		self.zero_crossing -= -x0 * x1 > 0
+		if len(self.values) > 1:
+			self.ssc -= (x1 - x0) * (x1 - self.values[1]) > 0
+			self.first_abs_diff = abs(self.values[1] - x1)
+		else:
+			self.first_abs_diff = None
+		self.first = x1
+		self.add_sums(x0, -1)
+		self.sorted_values.remove(x0)
+		evicted = self.seen - self.n #Position of the value that leaves the window
+		for extremes in [self.max_values, self.min_values, self.abs_max_values, self.abs_min_values]:
+			if extremes[0][0] == evicted:
+				extremes.popleft()
+		self.n -= 1
+
+	def quantiles(self, q):
+		if self.window is None:
+			if self.pending:
+				self.sketch.update(np.array(self.pending))
+				self.pending = []
+			return self.sketch.quantiles(q)
+		pos = np.asarray(q) * (self.n - 1)
+		lo = np.floor(pos).astype(int)
+		hi = np.minimum(lo + 1, self.n - 1)
+		low_values = np.array([self.sorted_values[i] for i in np.atleast_1d(lo)])
+		high_values = np.array([self.sorted_values[i] for i in np.atleast_1d(hi)])
+		return (low_values + (np.atleast_1d(pos) - np.atleast_1d(lo)) * (high_values - low_values)).reshape(np.shape(pos))
+
+	def features(self):
+		n = self.n
+		mean_d = self.sums[0] / n
+		mean = self.shift + mean_d
+		s2, s3, s4 = self.sums[1:] / n
+		m2 = max(s2 - mean_d * mean_d, 0.0)
+		if m2 <= 1e-12 * max(1.0, mean * mean): #Constant series, avoid dividing the rounding errors
+			m2 = 0.0
+		m3 = s3 - 3 * mean_d * s2 + 2 * mean_d ** 3
+		m4 = s4 - 4 * mean_d * s3 + 6 * mean_d * mean_d * s2 - 3 * mean_d ** 4
+		q25, median, q75, q95 = self.quantiles([0.25, 0.5, 0.75, 0.95])
+		with np.errstate(invalid='ignore', divide='ignore'):
+			if self.window is None:
+				items, cumulative = self.sketch.sorted_items()
+				mean_abs_dev = np.sum(np.diff(np.r_[0, cumulative]) * np.abs(items - mean)) / cumulative[-1]
+			else:
+				values = np.array(self.values)
+				mean_abs_dev = np.mean(np.abs(values - mean))
+				self.exp_sum = np.exp(values).sum()
+			f = {'mean': mean, 'median': median, 'max': self.max_values[0][1], 'min': self.min_values[0][1], 'std': np.sqrt(m2 * n / (n - 1)) if n > 1 else np.nan}
+			f['range'] = f['max'] - f['min']
+			f['max_over_Min'] = np.float64(f['max']) / f['min']
+			f['median_abs_dev'] = mean_abs_dev
+			f['mean_abs_chg'] = self.abs_diff_sum / (n - 1) if n > 1 else np.nan
+			f['mean_change_of_abs_change'] = (abs(self.last - self.previous) - self.first_abs_diff) / (n - 2) if n > 2 else np.nan
+			f['abs_max'], f['abs_min'] = self.abs_max_values[0][1], self.abs_min_values[0][1]
+			f['abs_avg'] = (f['abs_min'] + f['abs_max']) / 2
+			abs_mean_d = self.abs_sums[0] / n
+			f['abs_mean'] = abs(self.shift) + abs_mean_d
+			f['abs_std'] = np.sqrt(max(self.abs_sums[1] / n - abs_mean_d * abs_mean_d, 0))
+			f['abs_range'] = f['abs_max'] - f['abs_min']
+			f['skew'] = (np.sqrt(n * (n - 1)) / (n - 2) * m3 / m2 ** 1.5 if m2 > 0 else 0.0) if n > 2 else np.nan
+			f['q25'], f['q75'], f['q95'] = q25, q75, q95
+			f['iqr'] = q75 - q25
+			f['CPT5'] = self.exp_sum / (n * np.exp(np.sqrt(m2)))
+			#The last value wraps around to the first one
+			f['SSC'] = self.ssc + ((self.last - self.previous) * (self.last - self.first) > 0 if n > 1 else 0)
+			f['wave_lenght'] = self.abs_diff_sum + abs(self.first - self.last)
+			f['norm_entropy'] = self.cube_sum
+			f['SRAV'] = (self.sqrt_sum / n) ** 2
+			f['kurtosis'] = np.float64(m4) / m2 ** 2 - 3
+			f['zero_crossing'] = self.zero_crossing + (-self.last * self.first > 0)
+		return f
+
+class SeriesFeatureStream:
+	def __init__(self, columns, window=None, tumbling=False, error=0.01):
+		self.columns = columns
+		self.window = window
+		self.tumbling = tumbling
+		self.error = error
+		self.states = {}
+
+	def update(self, series_id, values):
+		#values has one value per column. With tumbling windows returns the features of the series when its window is complete
+		states = self.states.get(series_id)
+		if states is None:
+			states = self.states[series_id] = [RollingFeatures(self.window, self.error) for _ in self.columns]
+		for state, value in zip(states, values):
+			state.update(value)
+		if self.tumbling and states[0].n == self.window:
+			features = self.features(series_id)
+			del self.states[series_id]
+			return features
+
+	def features(self, series_id):
+		return {col + ('' if name == 'median_abs_dev' else '_') + name: value for col, state in zip(self.columns, self.states[series_id]) for name, value in state.features().items()}
+
+	def frame(self):
+		return pd.DataFrame.from_dict({series_id: self.features(series_id) for series_id in self.states}, orient='index').rename_axis('series_id')
+
+stream = SeriesFeatureStream(['col1', 'col2'], window=1000)
+for series_id, row in live_rows: #For example from a message queue
+	stream.update(series_id, row)
+	features = pd.DataFrame([stream.features(series_id)]) #Same columns as series_features, ready for model.predict
+stream = SeriesFeatureStream(['col1', 'col2'], window=60, tumbling=True)
+for series_id, row in live_rows:
+	features = stream.update(series_id, row)
+	if features is not None:
+		print(series_id, features)
 #Create a new column from conditions on other columns
 df['column_y'] = df[(df['column_x1'] | 'column_x2') & 'column_x3']
 df['column_y'] = df['column_y'].apply(bool)
@@ -763,6 +2463,57 @@ extract.range_cum_s(df["Close"])
 extract.structure_func(df["Close"])
 extract.kurtosis(df["Close"])
 extract.stetson_k(df["Close"])
+#Spectral features of many series at once instead of one df["Close"] at a time. The series (sorted with segment_offsets) are grouped in buckets of
+#the same length (pad='pow2' pads them with zeros to the next power of 2: fewer and faster buckets but the spectrum of padded series is smoothed) and
+#every bucket is a 2D array for one rfft and one Welch estimate. Gives the abs of the first fft coefficients, the dominant frequencies with their
+#power, the Welch power of the bands (n_bands equal bands up to fs/2 if no bands given) and the spectral centroid. Yields one frame per chunk of series
+from scipy.signal import welch
+
+def spectral_block(X, fs=1.0, n_coefficients=10, n_peaks=3, bands=None, n_bands=4, nperseg=256):
+	length = X.shape[1]
+	features = {}
+	spectrum = np.fft.rfft(X, axis=1)
+	coefficients = np.full((len(X), n_coefficients), np.nan)
+	coefficients[:, :min(n_coefficients, spectrum.shape[1])] = np.abs(spectrum[:, :n_coefficients])
+	for k in range(n_coefficients):
+		features['fft_abs_{}'.format(k)] = coefficients[:, k]
+	power = np.abs(spectrum[:, 1:])**2 #Without the mean
+	frequencies = np.fft.rfftfreq(length, 1 / fs)[1:]
+	peaks = np.argsort(-power, axis=1, kind='stable')[:, :n_peaks]
+	for k in range(n_peaks):
+		found = k < peaks.shape[1]
+		features['peak_freq_{}'.format(k)] = frequencies[peaks[:, k]] if found else np.full(len(X), np.nan)
+		features['peak_power_{}'.format(k)] = np.take_along_axis(power, peaks[:, k:k + 1], axis=1)[:, 0] if found else np.full(len(X), np.nan)
+	f, psd = welch(X, fs=fs, nperseg=min(nperseg, length), axis=1)
+	resolution = f[1] - f[0] if len(f) > 1 else np.nan
+	bands = bands or list(zip(np.linspace(0, fs / 2, n_bands + 1)[:-1], np.linspace(0, fs / 2, n_bands + 1)[1:]))
+	for k, (low, high) in enumerate(bands):
+		in_band = (f >= low) & ((f < high) | (high == fs / 2))
+		features['band_power_{}'.format(k)] = psd[:, in_band].sum(axis=1) * resolution
+	with np.errstate(invalid='ignore', divide='ignore'):
+		features['spectral_centroid'] = (psd * f).sum(axis=1) / psd.sum(axis=1)
+	return features
+
+def spectral_features(df, by='series_id', column='Close', pad=None, chunksize=100_000, **kwargs):
+	order, offsets, ids = segment_offsets(df[by])
+	values = df[column].to_numpy(dtype=np.float64)[order]
+	lengths = np.diff(offsets)
+	for chunk_start in range(0, len(ids), chunksize):
+		series = np.arange(chunk_start, min(chunk_start + chunksize, len(ids)))
+		bucket_lengths = lengths[series] if pad is None else 2**np.ceil(np.log2(lengths[series])).astype(np.int64)
+		blocks = []
+		for length in np.unique(bucket_lengths):
+			members = series[bucket_lengths == length]
+			positions = offsets[members][:, None] + np.arange(length)
+			X = np.where(np.arange(length) < lengths[members][:, None], values[np.minimum(positions, len(values) - 1)], 0.0)
+			blocks.append(pd.DataFrame(spectral_block(X, **kwargs), index=members))
+		features = pd.concat(blocks).sort_index().add_prefix(column + '_')
+		features.index = pd.Index(ids[series], name=by)
+		yield features
+
+for i, features in enumerate(spectral_features(df, by='series_id', column='Close', fs=1.0, n_coefficients=20, bands=[(0, 0.05), (0.05, 0.1), (0.1, 0.5)])):
+	features.to_parquet('spectral_{}.parquet'.format(i))
+df_spectral = pd.concat(spectral_features(df, by='series_id', column='Close', pad='pow2'))
 
 #Scaling features
 #Standard Scaler: The StandardScaler assumes your data is normally distributed within each feature and will scale them such that the distribution is now centred around 0, with a standard deviation of 1.
@@ -1417,48 +3168,66 @@ X_tsne = tsne.fit_transform(X)
 from sklearn import base
 from sklearn.model_selection import KFold
 
-class KFoldTargetEncoderTrain(base.BaseEstimator, base.TransformerMixin):
-	def __init__(self,colnames,targetName, n_fold=5, verbosity=True, discardOriginal_col=False):
-		self.colnames = colnames
-		self.targetName = targetName
+#K-fold target encoding of many columns at once, returns a new frame with the encoded columns and leaves the input untouched. Sums and counts of the target per fold and category are computed with
+#one bincount per column, and the out-of-fold mean of every fold is (total - fold) sums / (total - fold) counts, so no groupby per fold.
+#smoothing blends the category means with the global mean: (sum + smoothing*mean) / (count + smoothing). fit_transform returns the
+#out-of-fold encodings for train, transform uses the means of all the train data for validation/test (unseen categories get the global mean).
+#All folds come out of the same bincount, with n_jobs>1 the columns are encoded in parallel threads
+from concurrent.futures import ThreadPoolExecutor
+
+class KFoldTargetEncoder(base.BaseEstimator, base.TransformerMixin):
+	def __init__(self, columns, n_fold=5, smoothing=0, random_state=2019, n_jobs=1, verbosity=True):
+		self.columns = columns
 		self.n_fold = n_fold
+		self.smoothing = smoothing
+		self.random_state = random_state
+		self.n_jobs = n_jobs
 		self.verbosity = verbosity
-		self.discardOriginal_col = discardOriginal_col
 
-	def fit(self, X, y=None):
+	def fit(self, X, y):
+		self.fit_transform(X, y)
 		return self
 
-	def transform(self,X):
-		assert(type(self.targetName) == str)
-		assert(type(self.colnames) == str)
-		assert(self.colnames in X.columns)
-		assert(self.targetName in X.columns)
-
-		mean_of_target = X[self.targetName].mean()
-		kf = KFold(n_splits = self.n_fold, shuffle = True, random_state=2019)
-
-		col_mean_name = self.colnames + '_' + 'Kfold_Target_Enc'
-		X[col_mean_name] = np.nan
-
-		for tr_ind, val_ind in kf.split(X):
-			X_tr, X_val = X.iloc[tr_ind], X.iloc[val_ind]
-			X.loc[X.index[val_ind], col_mean_name] = X_val[self.colnames].map(X_tr.groupby(self.colnames)[self.targetName].mean())
-			X[col_mean_name].fillna(mean_of_target, inplace = True)
-
+	def fit_transform(self, X, y):
+		y = np.asarray(y, dtype=np.float64)
+		self.prior_ = y.mean()
+		folds = np.empty(len(y), dtype=np.int64)
+		for fold, (tr_ind, val_ind) in enumerate(KFold(n_splits=self.n_fold, shuffle=True, random_state=self.random_state).split(y)):
+			folds[val_ind] = fold
+		if self.n_jobs == 1:
+			results = [self.encode_column(X[col], y, folds) for col in self.columns]
+		else:
+			with ThreadPoolExecutor(self.n_jobs) as executor:
+				results = list(executor.map(lambda col: self.encode_column(X[col], y, folds), self.columns))
+		self.mappings_ = {col: mapping for col, (mapping, _) in zip(self.columns, results)}
+		encoded = {col + '_Kfold_Target_Enc': enc for col, (_, enc) in zip(self.columns, results)}
 		if self.verbosity:
-			encoded_feature = X[col_mean_name].values
-			print('Correlation between the new feature, {} and, {} is {}.'.format(col_mean_name,self.targetName,
-			np.corrcoef(X[self.targetName].values, encoded_feature)[0][1]))
-
-		if self.discardOriginal_col:
-			X = X.drop(self.targetName, axis=1)
-
-		return X
-
-targetc = KFoldTargetEncoderTrain('column','target',n_fold=5)
-new_df = targetc.fit_transform(df)
-
-new_df[['column_Kfold_Target_Enc','column']]
+			for col in self.columns:
+				print('Correlation between the new feature, {}_Kfold_Target_Enc and the target is {}.'.format(col, np.corrcoef(y, encoded[col + '_Kfold_Target_Enc'])[0][1]))
+		return pd.DataFrame(encoded, index=X.index)
+
+	def encode_column(self, x, y, folds):
+		codes, categories = pd.factorize(x)
+		n = len(categories) + 1 #The last one is for missing values
+		codes = np.where(codes < 0, n - 1, codes)
+		sums = np.bincount(folds * n + codes, weights=y, minlength=self.n_fold * n).reshape(self.n_fold, n)
+		counts = np.bincount(folds * n + codes, minlength=self.n_fold * n).reshape(self.n_fold, n)
+		with np.errstate(invalid='ignore', divide='ignore'):
+			out_of_fold = (sums.sum(axis=0) - sums + self.smoothing * self.prior_) / (counts.sum(axis=0) - counts + self.smoothing)
+			means = (sums.sum(axis=0) + self.smoothing * self.prior_) / (counts.sum(axis=0) + self.smoothing)
+		return (categories, means), np.nan_to_num(out_of_fold[folds, codes], nan=self.prior_)
+
+	def transform(self, X):
+		encoded = {}
+		for col in self.columns:
+			categories, means = self.mappings_[col]
+			idx = np.where(X[col].isna(), len(means) - 1, categories.get_indexer(X[col]))
+			encoded[col + '_Kfold_Target_Enc'] = np.nan_to_num(np.where(idx >= 0, means[idx], np.nan), nan=self.prior_)
+		return pd.DataFrame(encoded, index=X.index)
+
+target_encoder = KFoldTargetEncoder(['column1', 'column2', 'column3'], n_fold=5, smoothing=10, n_jobs=4)
+train_enc = target_encoder.fit_transform(X_train, y_train)
+val_enc = target_encoder.transform(X_val)
 
 
 #########